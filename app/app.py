@@ -1,6 +1,5 @@
 import json
 from pathlib import Path
-import csv
 import boto3
 import gradio as gr
 import os
@@ -9,6 +8,10 @@ import logging
 from gradio.layouts.accordion import Accordion
 
 from rags import Rag
+from conversations import ConversationStore
+from log_writer import LogWriter
+from profiler import SamplingProfiler
+from singleflight import SingleFlight, request_key, share
 from dotenv import dotenv_values
 import yaml
 import random
@@ -18,12 +21,14 @@ import re
 import io
 from PIL import Image
 import argparse
+import signal
+import sys
 from datetime import datetime
 from gradio_modal import Modal
 
 ############# LOCAL IMPORTS ##################
-from app_logging import get_usage_stats, log_token_usage, read_usage_log, plot_daily_tokens_heatmap, update_usage_log, plot_cumulative_tokens, export_history, get_eval_stats_plot
-from app_utils import get_mfa_response, token_auth, dot_progress_bar, get_admin_username, from_list_to_messages
+from app_logging import TOKEN_USAGE, USAGE_LOG, get_usage_stats, log_token_usage, read_usage_log, plot_daily_tokens_heatmap, update_usage_log, plot_cumulative_tokens, export_history, remove_history_export, get_eval_stats_plot
+from app_utils import get_mfa_response, token_auth, dot_progress_bar, get_admin_username, from_list_to_messages, rag_settings
 
 ############# CLI ARGUMENTS ##################
 parser = argparse.ArgumentParser()
@@ -32,6 +37,7 @@ parser.add_argument('--sslcert', action="store", dest='ssl_certfile', default=No
 parser.add_argument('--sslkey', action="store", dest='ssl_keyfile', default=None)
 parser.add_argument('--debug', action="store", dest='debug', default=False, type=bool)
 parser.add_argument('--local', action="store", dest='local', default=False, type=bool)
+parser.add_argument('--profile', action="store_true", dest='profile', help="profile a sample of the chat requests from start-up")
 args = parser.parse_args()
 
 ############# LOGGER ##################
@@ -53,15 +59,17 @@ os.chdir(wd)
 LOG_STAT_FILE = "logs/token_usage.json"
 LOG_FILE = "logs/usage_log.json"
 LOG_EVAL_FILE = "logs/evaluations.jsonl"
-LOG_CHAT_HISTORY = "logs/chat_history.txt"
 CUSTOM_THEME = gr.themes.Ocean().set(body_background_fill="linear-gradient(to right top, #f2f2f2, #f1f1f4, #f0f1f5, #eff0f7, #edf0f9, #ebf1fb, #e9f3fd, #e6f4ff, #e4f7ff, #e2faff, #e2fdff, #e3fffd)")
-RAG = Rag(session=Session(),
-          model=config.get("bedrock").get("models").get("model-id"),
-          embedder=config.get("bedrock").get("embedder-id"),
-          vector_store=config.get("vector-db-path"),
-          region=config.get("bedrock").get("region"),
-          model_pro=config.get("bedrock").get("models").get("pro-model-id"),
-          model_low=config.get("bedrock").get("models").get("low-model-id"))
+RAG = Rag(session=Session(), **rag_settings(config))
+# requests beyond the chat concurrency limit wait in the Gradio queue, where the degradation controller
+# neither counts nor sheds them: its in-flight cap must stay below the limit to reject them quickly instead
+if RAG.degradation.max_in_flight >= config.get('gradio').get('concurrency-limit', 20):
+    logger.warning(f"degradation max-in-flight ({RAG.degradation.max_in_flight}) should be lower than gradio concurrency-limit "
+                   f"({config.get('gradio').get('concurrency-limit', 20)}), otherwise excess requests are queued instead of rejected")
+CONVERSATIONS = ConversationStore.from_config(config.get("conversations"))
+LOG_WRITER = LogWriter.from_config(config.get("log-writer"))
+IN_FLIGHT = SingleFlight.from_config(config.get("coalescing"))
+PROFILER = SamplingProfiler.from_config(config.get("profiling"), enabled=True if args.profile else None)
 
 
 def update_rag(mfa_token, use_mfa_session=args.local):
@@ -74,16 +82,11 @@ def update_rag(mfa_token, use_mfa_session=args.local):
                 session = boto3.Session(aws_access_key_id=mfa_response['Credentials']['AccessKeyId'],
                                         aws_secret_access_key=mfa_response['Credentials']['SecretAccessKey'],
                                         aws_session_token=mfa_response['Credentials']['SessionToken'])
+                expiration = mfa_response['Credentials']['Expiration']
             else:
                 session = Session()
-            rag_attempt = Rag(session=session,
-                            model=config.get("bedrock").get("models").get("model-id"),
-                            embedder=config.get("bedrock").get("embedder-id"),
-                            vector_store=config.get("vector-db-path"),
-                            region=config.get("bedrock").get("region"),
-                            model_pro=config.get("bedrock").get("models").get("pro-model-id"),
-                            model_low=config.get("bedrock").get("models").get("low-model-id"))
-            RAG = rag_attempt
+                expiration = None
+            RAG.update_session(session, expiration=expiration)
             logger.debug("Rag updated")
             return True, ""
         except Exception as e:
@@ -113,6 +116,7 @@ def check_ban(ip_address: str, max_tokens: int = 20000) -> bool:
     else:
         return False
 
+@PROFILER.sampled
 def reply(message, history, is_admin, enable_rag, query_aug, additional_context, request: gr.Request):
     global RAG
     admin_or_test = is_admin or request.username=="test"
@@ -121,19 +125,46 @@ def reply(message, history, is_admin, enable_rag, query_aug, additional_context,
         logger.error("exceeded daily usage limit!")
         gr.Error("Error: exceeded daily usage limit")
         return [gr.ChatMessage(role="assistant", content="Sembra che tu abbia esaurito la tua quota giornaliera. Riprova più tardi.")]
+    mode = RAG.degradation.admit()
+    if mode == "shedding":
+        logger.warning(f"Request rejected, service overloaded: {RAG.degradation.status()}")
+        return [gr.ChatMessage(role="assistant", content=f"Il servizio è momentaneamente sovraccarico. Riprova tra {RAG.degradation.retry_after} secondi.")]
     try:
         if enable_rag:
-            response = RAG.invoke({"question": message,
-                                   "history": from_list_to_messages(history),
-                                   "additional_context": additional_context,
-                                   "input_tokens_count":0,
-                                   "output_tokens_count":0,
-                                   "query_aug": query_aug})
+            user_turns = [m["content"] for m in history if m["role"] == "user"]
+            summary = CONVERSATIONS.get(request.session_hash, len(user_turns), user_turns[-1]) if user_turns else None
+            rag_input = {"question": message,
+                         # the full history is only needed when the server-side summary is not available
+                         "history": [] if summary else from_list_to_messages(history),
+                         "summary": summary or "",
+                         "history_depth": len(user_turns),
+                         "additional_context": additional_context,
+                         "input_tokens_count":0,
+                         "output_tokens_count":0,
+                         "cache_read_tokens_count":0,
+                         "cache_write_tokens_count":0,
+                         "query_aug": query_aug,
+                         "degradation": mode}
+            if user_turns:
+                response, participants, leader = RAG.invoke(rag_input), 1, True
+            else:
+                # identical opening questions asked at the same time (e.g. the examples) share one pipeline run
+                key = request_key(message, empty_history=True, query_aug=query_aug, additional_context=additional_context, mode=mode)
+                response, participants, leader = IN_FLIGHT.do(key, lambda: RAG.invoke(rag_input))
             answer = response["answer"]
-            input_tokens_count = response["input_tokens_count"]
-            output_tokens_count = response["output_tokens_count"]
-            update_usage_log(request.client.host, input_tokens_count+output_tokens_count*4, False)
-            log_token_usage(request.client.host, input_tokens_count, output_tokens_count)
+            if response.get("standalone_question") or not user_turns:
+                CONVERSATIONS.update(request.session_hash, len(user_turns)+1, message, response.get("standalone_question") or message, answer)
+            else:
+                # follow-up answered without consolidation (degraded service): the raw question would lose the
+                # previous context, the next turn rebuilds it from the full history instead
+                CONVERSATIONS.drop(request.session_hash)
+            # the tokens of a shared run are split among the users who asked
+            input_tokens_count = share(response["input_tokens_count"], participants, leader)
+            output_tokens_count = share(response["output_tokens_count"], participants, leader)
+            cache_read_tokens_count = share(response.get("cache_read_tokens_count", 0), participants, leader)
+            cache_write_tokens_count = share(response.get("cache_write_tokens_count", 0), participants, leader)
+            update_usage_log(request.client.host, input_tokens_count+cache_write_tokens_count+output_tokens_count*4, False)
+            log_token_usage(request.client.host, input_tokens_count, output_tokens_count, cache_read_tokens_count, cache_write_tokens_count)
             answer = re.sub(r"(\[[\d,\s]*\])",r"<sup>\1</sup>",answer)
             citations = {}
             citations_str = ""
@@ -155,6 +186,15 @@ def reply(message, history, is_admin, enable_rag, query_aug, additional_context,
     except Exception as e:
         logger.error(str(e))
         gr.Error("Error: " + str(e))
+    finally:
+        RAG.degradation.release()
+
+def drop_conversation(request: gr.Request):
+    CONVERSATIONS.drop(request.session_hash)
+    remove_history_export(request.session_hash)
+
+def export_conversation(history, request: gr.Request):
+    return export_history(history, request.session_hash)
 
 def usereval(*args):
     global eval_components
@@ -166,8 +206,7 @@ def usereval(*args):
             "liked": args[-3],
             "evaluation": dict(zip([c[0] for c in eval_components], args[:-3])),
             "conversation": json.dumps(args[-2])}
-    with open("logs/evaluations.jsonl", "a") as file:
-        file.write(json.dumps(data) + '\n')
+    LOG_WRITER.write_jsonl(LOG_EVAL_FILE, data)
     return [None] * len(args[:-3]) + [Modal(visible=False)]
 
 def onload(disclaimer_seen:bool, request: gr.Request):
@@ -193,6 +232,23 @@ def onload(disclaimer_seen:bool, request: gr.Request):
             logging_info]
 
 
+def toggle_profiling(enabled: bool, request: gr.Request):
+    if request.username != get_admin_username():
+        return PROFILER.status()
+    if enabled:
+        PROFILER.enable()
+    else:
+        PROFILER.disable()
+    return PROFILER.status()
+
+def export_profile(request: gr.Request):
+    if request.username != get_admin_username():
+        return None
+    path = PROFILER.export()
+    if path is None:
+        gr.Warning("No profiling samples collected yet.")
+    return path
+
 def toggle_interactivity(is_admin):
     logger.debug("Updating admin functionalities")
     return [gr.UploadButton(file_count="single", interactive=is_admin),
@@ -203,7 +259,7 @@ def toggle_interactivity(is_admin):
 
 def update_stats():
     stats = get_usage_stats()
-    return [gr.Plot(plot_cumulative_tokens()), gr.Plot(get_eval_stats_plot()), stats['total_users'], stats['avg_input_tokens_per_user_per_day'], stats['avg_output_tokens_per_user_per_day'], round(stats['avg_input_tokens_per_user_per_day']/stats['avg_output_tokens_per_user_per_day'],2)]
+    return [gr.Plot(plot_cumulative_tokens()), gr.Plot(get_eval_stats_plot()), stats['total_users'], stats['avg_input_tokens_per_user_per_day'], stats['avg_output_tokens_per_user_per_day'], round(stats['avg_input_tokens_per_user_per_day']/stats['avg_output_tokens_per_user_per_day'],2), RAG.degradation.status(), PROFILER.status()]
 
 with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {document.getElementById('options').style.display='none';}", theme=CUSTOM_THEME, css_paths="app.css", head_paths="app_head.html") as demo:
     with Modal(visible=False) as modal:
@@ -258,6 +314,9 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
                                      save_history=True,
                                      analytics_enabled = False,
                                      examples=[[e] for e in config.get('gradio').get('examples')],
+                                     # applies to the submit and example events: with Gradio's default of 1,
+                                     # requests never overlap (and identical ones are never coalesced)
+                                     concurrency_limit=config.get('gradio').get('concurrency-limit', 20),
                                      additional_inputs=[admin_state,
                                                         kb,
                                                         qa,
@@ -270,7 +329,7 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
                                      )
         download_btn = gr.Button("Scarica la conversazione", variant='secondary')
         download_btn_hidden = gr.DownloadButton(visible=False, elem_id="download_btn_hidden")
-        download_btn.click(fn=export_history, inputs=chatbot, outputs=[download_btn_hidden]).then(fn=None, inputs=None,
+        download_btn.click(fn=export_conversation, inputs=chatbot, outputs=[download_btn_hidden]).then(fn=None, inputs=None,
                                                                                         outputs=None,
                                                                                         js="() => document.querySelector('#download_btn_hidden').click()")
 
@@ -283,13 +342,9 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
         def manual_logger(data: gr.LikeData, messages: list, double_log_flag, request: gr.Request):
             if double_log_flag:
                 log_filepath = "./logs/log_"+request.username.replace(".","_").replace("/","_") +"_"+ request.client.host.replace(".", "_") + ".csv"
-                is_new = not Path(log_filepath).exists()
                 csv_data = [json.dumps(messages), data.value, data.index, data.liked, request.client.host, request.username, str(datetime.now())]
-                with open(log_filepath, "a", encoding="utf-8", newline="") as csvfile:
-                    writer = csv.writer(csvfile)
-                    if is_new:
-                        writer.writerow(["conversation", "message", "index", "flag", "host",  "username", "timestamp"])
-                    writer.writerow(gr.utils.sanitize_list_for_csv(csv_data))
+                LOG_WRITER.write_csv(log_filepath, gr.utils.sanitize_list_for_csv(csv_data),
+                                     header=["conversation", "message", "index", "flag", "host",  "username", "timestamp"])
             return not double_log_flag
 
         def open_modal(data: gr.LikeData):
@@ -322,6 +377,7 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
                 stats_input = gr.Textbox(label="Average user input [tokens/dd]", value=f"{stats['avg_input_tokens_per_user_per_day']}", interactive=False)
                 stats_output = gr.Textbox(label="Average user output [tokens/dd]", value=f"{stats['avg_output_tokens_per_user_per_day']}", interactive=False)
                 stats_ratio = gr.Textbox(label="Input/Output ratio", value=f"{round(stats['avg_input_tokens_per_user_per_day']/stats['avg_output_tokens_per_user_per_day'],2)}", interactive=False)
+                stats_mode = gr.Textbox(label="Service mode", value=RAG.degradation.status(), interactive=False)
             with gr.Row():
                 stats_plot = gr.Plot(plot_cumulative_tokens())
                 eval_plot = gr.Plot(get_eval_stats_plot())
@@ -329,6 +385,15 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
             with gr.Row():
                 usage_log_btn = gr.DownloadButton("Usage Log Download", value="logs/usage_log.json")
                 evaluation_log_btn = gr.DownloadButton("Evaluations Download", value="logs/evaluations.jsonl")
+        with gr.Group():
+            with gr.Row():
+                profiling_toggle = gr.Checkbox(label="Request profiling", value=PROFILER.enabled)
+                profiling_status = gr.Textbox(label="Profiler", value=PROFILER.status(), interactive=False)
+                profile_btn = gr.Button("Profile Download (folded stacks)", variant='secondary')
+                profile_btn_hidden = gr.DownloadButton(visible=False, elem_id="profile_btn_hidden")
+            profiling_toggle.input(toggle_profiling, inputs=profiling_toggle, outputs=profiling_status)
+            profile_btn.click(fn=export_profile, inputs=None, outputs=[profile_btn_hidden]).then(fn=None, inputs=None, outputs=None,
+                                                                                                js="() => document.querySelector('#profile_btn_hidden').click()")
         with gr.Group():
             gr.Image(label="Workflow schema", value=Image.open(io.BytesIO(RAG.get_image())))
 
@@ -337,9 +402,22 @@ with gr.Blocks(title=gui_config.get("app_title"), js="function anything() {docum
     mfa_input.submit(fn=update_rag, inputs=[mfa_input], outputs=[admin_state,mfa_input])
     btn.click(fn=update_rag, inputs=[mfa_input], outputs=[admin_state,mfa_input])
     admin_state.change(toggle_interactivity, inputs=admin_state, outputs=[upload_button,stats_tab,kb,qa])
-    stats_tab.select(update_stats, inputs=None, outputs=[stats_plot, eval_plot, stats_users, stats_input, stats_output, stats_ratio] )
+    stats_tab.select(update_stats, inputs=None, outputs=[stats_plot, eval_plot, stats_users, stats_input, stats_output, stats_ratio, stats_mode, profiling_status] )
     demo.load(onload, inputs=disclaimer_seen, outputs=[admin_state,modal,disclaimer_seen,kb,qa,session_state])
+    demo.unload(drop_conversation)
+
+def shutdown(signum, frame):
+    # SIGTERM (e.g. docker stop) skips the atexit handlers: flush the logs kept in memory before exiting
+    logger.info("Shutting down, flushing logs...")
+    LOG_WRITER.close()
+    TOKEN_USAGE.close()
+    USAGE_LOG.close()
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, shutdown)
 
+# bounded queue: when full, new requests are refused right away instead of piling up
+demo.queue(max_size=config.get('gradio').get('queue-size', 50))
 demo.launch(server_name="0.0.0.0",
             server_port=7860,
             auth=token_auth,
@@ -1,40 +1,48 @@
 from datetime import datetime, timedelta
 import os
 import json
+import copy
 import dayplot as dp
 from collections import defaultdict
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 import logging
 import numpy as np
+import re
+
+from log_writer import JsonSnapshot, read_lines
 
 LOG_STAT_FILE = "logs/token_usage.json"
 LOG_FILE = "logs/usage_log.json"
 LOG_EVAL_FILE = "logs/evaluations.jsonl"
-LOG_CHAT_HISTORY = "logs/chat_history.txt"
+LOG_CHAT_HISTORY_FOLDER = "logs/exports"
 
 logger = logging.getLogger(__name__)
+
+# token usage and quotas are kept in memory and written back in the background (see JsonSnapshot)
+TOKEN_USAGE = JsonSnapshot(LOG_STAT_FILE)
+USAGE_LOG = JsonSnapshot(LOG_FILE)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 def get_eval_stats_plot():
     # Initialize distribution stats for 'values' fields
-    if not os.path.exists("logs/evaluations.jsonl"):
+    if not os.path.exists(LOG_EVAL_FILE):
         logger.warning("No data to plot.")
         return
 
     values_distributions = defaultdict(list)
 
     # Process the 'values' field again to get distributions
-    with open("logs/evaluations.jsonl", "r", encoding="utf-8") as file:
-        for line in file:
-            try:
-                data = json.loads(line.strip())
-                if "evaluation" in data and isinstance(data["evaluation"], dict):
-                    for key, value in data["evaluation"].items():
-                        values_distributions[key].append(value)
-                values_distributions["liked (bool)"].append(int(eval(data["liked"]))*5) #convert bool to int and from 0-1 to 0-5
-            except json.JSONDecodeError:
-                continue
+    # rotated (compressed) evaluation logs included
+    for line in read_lines(LOG_EVAL_FILE):
+        try:
+            data = json.loads(line.strip())
+            if "evaluation" in data and isinstance(data["evaluation"], dict):
+                for key, value in data["evaluation"].items():
+                    values_distributions[key].append(value)
+            values_distributions["liked (bool)"].append(int(eval(data["liked"]))*5) #convert bool to int and from 0-1 to 0-5
+        except json.JSONDecodeError:
+            continue
 
     numeric_data = {key: values for key, values in values_distributions.items() if all(isinstance(v, (int, float)) or v is None for v in values)}
 
@@ -60,11 +68,14 @@ def get_eval_stats_plot():
 
 def get_usage_stats():
     """Computes total users, total input/output tokens, averages, and cumulative daily token usage."""
-    if not os.path.exists(LOG_STAT_FILE):
+    data = TOKEN_USAGE.read(copy.deepcopy)
+    if not data:
         return {
             "total_users": 0,
             "total_input_tokens": 0,
             "total_output_tokens": 0,
+            "total_cache_read_tokens": 0,
+            "total_cache_write_tokens": 0,
             "avg_input_tokens_per_user_per_day": 0,
             "avg_output_tokens_per_user_per_day": 0,
             "cumulative_tokens_per_day": [],
@@ -72,12 +83,11 @@ def get_usage_stats():
             "cumulative_output_tokens_per_day": []
         }
 
-    with open(LOG_STAT_FILE, "r") as file:
-        data = json.load(file)
-
     total_users = len(data)
     total_input_tokens = 0
     total_output_tokens = 0
+    total_cache_read_tokens = 0
+    total_cache_write_tokens = 0
     daily_totals = defaultdict(lambda: [0, 0])  # {date: [input_tokens, output_tokens]}
 
     for usage in data.values():
@@ -91,6 +101,10 @@ def get_usage_stats():
             total_output_tokens += tokens
             daily_totals[date][1] += tokens
 
+        # older entries predate prompt caching and have no cache counters
+        total_cache_read_tokens += sum(tokens for tokens, _ in usage.get("cache_read_tokens", []))
+        total_cache_write_tokens += sum(tokens for tokens, _ in usage.get("cache_write_tokens", []))
+
     # Compute averages
     active_days = len(daily_totals)
     avg_input_tokens_per_user_per_day = total_input_tokens / (total_users * active_days) if total_users > 0 and active_days > 0 else 0
@@ -115,6 +129,8 @@ def get_usage_stats():
         "total_users": total_users,
         "total_input_tokens": total_input_tokens,
         "total_output_tokens": total_output_tokens,
+        "total_cache_read_tokens": total_cache_read_tokens,
+        "total_cache_write_tokens": total_cache_write_tokens,
         "avg_input_tokens_per_user_per_day": round(avg_input_tokens_per_user_per_day),
         "avg_output_tokens_per_user_per_day": round(avg_output_tokens_per_user_per_day),
         "cumulative_tokens_per_day": cumulative_tokens_per_day,
@@ -123,28 +139,22 @@ def get_usage_stats():
         "daily_totals": daily_totals,
     }
 
-def log_token_usage(ip_address: str, input_tokens: int, output_tokens: int):
-    """Logs the input and output token usage for a given IP address with timestamps."""
-    os.makedirs(os.path.dirname(LOG_STAT_FILE), exist_ok=True)
+def log_token_usage(ip_address: str, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0):
+    """Logs the input, output and prompt cache (read/write) token usage for a given IP address with timestamps."""
+    now = datetime.now().isoformat()
 
-    if os.path.exists(LOG_STAT_FILE):
-        with open(LOG_STAT_FILE, "r") as file:
-            data = json.load(file)
-    else:
-        data = {}
+    def append(data: dict):
+        # Ensure IP has an entry
+        if ip_address not in data:
+            data[ip_address] = {"input_tokens": [], "output_tokens": []}
 
-    # Ensure IP has an entry
-    if ip_address not in data:
-        data[ip_address] = {"input_tokens": [], "output_tokens": []}
+        # Append new token usage
+        data[ip_address]["input_tokens"].append((input_tokens, now))
+        data[ip_address]["output_tokens"].append((output_tokens, now))
+        data[ip_address].setdefault("cache_read_tokens", []).append((cache_read_tokens, now))
+        data[ip_address].setdefault("cache_write_tokens", []).append((cache_write_tokens, now))
 
-    # Append new token usage
-    now = datetime.now().isoformat()
-    data[ip_address]["input_tokens"].append((input_tokens, now))
-    data[ip_address]["output_tokens"].append((output_tokens, now))
-
-    # Save back to file
-    with open(LOG_STAT_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+    TOKEN_USAGE.update(append)
 
 def plot_cumulative_tokens():
     """Plots cumulative token usage over time with stacked bars for input and output tokens and a line for total cumulative tokens using Plotly."""
@@ -199,43 +209,42 @@ def plot_daily_tokens_heatmap():
     return fig
 
 def read_usage_log(ip_address: str) -> (int, datetime, bool):
-    if not os.path.exists(LOG_FILE):
-        return 0, datetime.now(), False
-    with open(LOG_FILE, "r") as file:
-        data = json.load(file)
-    if ip_address in data:
-        entry = data[ip_address]
+    entry = USAGE_LOG.read(lambda data: dict(data[ip_address]) if ip_address in data else None)
+    if entry is not None:
         return entry["tokens_count"], datetime.fromisoformat(entry["last_call"]), entry["banned_flag"]
     return 0, datetime.now(), False
 
 def update_usage_log(ip_address: str, tokens_consumed: int, banned: bool):
     """Updates the usage log, modifying the entry for the given IP address."""
-    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    def update(data: dict):
+        was_banned = data.get(ip_address, {}).get("banned_flag", False)
+        tokens_count = data.get(ip_address, {}).get("tokens_count", 0) + tokens_consumed
 
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "r") as file:
-            data = json.load(file)
-    else:
-        data = {}
+        if was_banned and not banned:
+            tokens_count = 0  # Reset tokens if ban is lifted
 
-    was_banned = data.get(ip_address, {}).get("banned_flag", False)
-    tokens_count = data.get(ip_address, {}).get("tokens_count", 0) + tokens_consumed
+        data[ip_address] = {
+            "tokens_count": tokens_count,
+            "last_call": datetime.now().isoformat(),
+            "banned_flag": banned
+        }
 
-    if was_banned and not banned:
-        tokens_count = 0  # Reset tokens if ban is lifted
+    USAGE_LOG.update(update)
 
-    data[ip_address] = {
-        "tokens_count": tokens_count,
-        "last_call": datetime.now().isoformat(),
-        "banned_flag": banned
-    }
 
-    with open(LOG_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+def history_export_path(session_hash: str) -> str:
+    return os.path.join(LOG_CHAT_HISTORY_FOLDER, f"chat_history_{re.sub(r'[^A-Za-z0-9_-]', '_', str(session_hash))}.txt")
 
-
-def export_history(history):
-    with open(LOG_CHAT_HISTORY, 'w') as f:
+def export_history(history, session_hash: str):
+    # one file per session, so that concurrent downloads do not overwrite each other
+    path = history_export_path(session_hash)
+    os.makedirs(LOG_CHAT_HISTORY_FOLDER, exist_ok=True)
+    with open(path, 'w') as f:
         f.write(str(history))
-    return LOG_CHAT_HISTORY
+    return path
+
+def remove_history_export(session_hash: str):
+    path = history_export_path(session_hash)
+    if os.path.exists(path):
+        os.remove(path)
 
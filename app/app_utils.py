@@ -2,6 +2,7 @@ import logging
 import boto3
 from dotenv import dotenv_values
 import json
+from functools import lru_cache
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 logger = logging.getLogger(__name__)
@@ -13,6 +14,25 @@ GRADIO_SECRETS = "gradio_secrets.env"
 def get_admin_username():
     return dotenv_values(GRADIO_SECRETS).get("GRADIO_ADMNUSR")
 
+def rag_settings(config: dict) -> dict:
+    """Rag keyword arguments (models, embedder, vector store and pipeline options) from the settings file."""
+    return dict(model=config.get("bedrock").get("models").get("model-id"),
+                embedder=config.get("bedrock").get("embedder-id"),
+                vector_store=config.get("vector-db-path"),
+                region=config.get("bedrock").get("region"),
+                client=config.get("bedrock").get("client"),
+                model_pro=config.get("bedrock").get("models").get("pro-model-id"),
+                model_low=config.get("bedrock").get("models").get("low-model-id"),
+                model_ultralow=config.get("bedrock").get("models").get("ultra-low-model-id"),
+                routing=config.get("routing"),
+                degradation=config.get("degradation"),
+                quantization=config.get("quantization"),
+                retrieval=config.get("retrieval"),
+                chunk_size=config.get("chunk-size", 500),
+                chunk_overlap=config.get("chunk-overlap", 100),
+                parent_chunk_size=config.get("parent-chunk-size", None),
+                parent_token_budget=config.get("parent-token-budget", 3000))
+
 def from_list_to_messages(chat:list[dict]):
     template = ChatPromptTemplate([MessagesPlaceholder("history")]).invoke({"history":[(message["role"],message["content"]) for message in chat]})
     return template.to_messages()
@@ -31,15 +51,19 @@ def token_auth(username: str, password: str):
                 return True
         return False
 
+@lru_cache(maxsize=1)
+def sts_client():
+    # built once and reused, so that MFA checks do not pay for a new client and connection each time
+    return boto3.client('sts',
+                        aws_access_key_id=dotenv_values(AWS_SECRETS).get("AWS_ACCESS_KEY_ID"),
+                        aws_secret_access_key=dotenv_values(AWS_SECRETS).get("AWS_SECRET_ACCESS_KEY"))
+
 def get_mfa_response(mfa_token, duration: int = 900):
     logger.debug("Checking MFA token...")
     if len(mfa_token) != 6:
         return None
     try:
-        sts_client = boto3.client('sts',
-                            aws_access_key_id=dotenv_values(AWS_SECRETS).get("AWS_ACCESS_KEY_ID"),
-                            aws_secret_access_key=dotenv_values(AWS_SECRETS).get("AWS_SECRET_ACCESS_KEY"))
-        response = sts_client.get_session_token(DurationSeconds=duration,
+        response = sts_client().get_session_token(DurationSeconds=duration,
                                                 SerialNumber=dotenv_values(AWS_SECRETS).get("AWS_ARN_MFA_DEVICE"),
                                                 TokenCode=mfa_token)
         return response
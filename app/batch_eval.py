@@ -0,0 +1,231 @@
+"""
+Offline batch evaluation of the RAG pipeline.
+
+Reads a JSONL file of cases, one per line:
+    {"id": "q1", "question": "...", "history": [{"role": "user", "content": "..."}, ...],
+     "additional_context": "...", "query_aug": false}
+(only "question" is required, the line number is used when "id" is missing) and runs them through Rag
+with a pool of workers, within a budget of cases started per minute (each case makes up to 4 model calls:
+consolidation, query augmentation, generation and escalation). Results are appended to the output JSONL
+as soon as each case completes, one line per completed case; failed attempts go to <output>.errors.jsonl
+instead. Rerunning the same command resumes from where it stopped, skipping the cases already completed
+(failed cases are retried).
+
+Usage:
+    python batch_eval.py --settings reuma_settings.yaml --input cases.jsonl --output results.jsonl --workers 4 --max-rpm 60
+    python batch_eval.py --settings reuma_settings.yaml --input cases.jsonl --output results.jsonl --stub-models
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+from boto3 import Session
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from app_utils import from_list_to_messages, rag_settings
+from rags import Rag
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spread the calls evenly so that no more than max_rpm calls start in a minute (no limit if None)."""
+
+    def __init__(self, max_rpm: float | None = None):
+        self.interval = 60 / max_rpm if max_rpm else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def read_cases(input_file: str) -> list[dict]:
+    cases = []
+    with open(input_file, "r", encoding="utf-8") as file:
+        for i, line in enumerate(file):
+            if line.strip() == "":
+                continue
+            case = json.loads(line)
+            case.setdefault("id", str(i))
+            cases.append(case)
+    return cases
+
+
+def errors_file(output_file: str) -> str:
+    return f"{os.path.splitext(output_file)[0]}.errors.jsonl"
+
+
+def read_checkpoint(output_file: str) -> set[str]:
+    """Ids of the cases already completed without errors in a previous run."""
+    completed = set()
+    if not os.path.exists(output_file):
+        return completed
+    with open(output_file, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # truncated last line of an interrupted run
+            if result.get("error") is None:
+                completed.add(str(result["id"]))
+    return completed
+
+
+def run_case(rag: Rag, case: dict) -> dict:
+    """Run a case through the graph, step by step, to time each node."""
+    state = {"question": case["question"],
+             "history": from_list_to_messages(case.get("history", [])),
+             "additional_context": case.get("additional_context", ""),
+             "input_tokens_count": 0,
+             "output_tokens_count": 0,
+             "cache_read_tokens_count": 0,
+             "cache_write_tokens_count": 0,
+             "query_aug": case.get("query_aug", False)}
+    latency = {}
+    start = last = time.perf_counter()
+    for update in rag.graph.stream(state, stream_mode="updates"):
+        now = time.perf_counter()
+        for node, values in update.items():
+            latency[node] = latency.get(node, 0.0) + (now - last)
+            state.update(values or {})
+        last = now
+    latency["total"] = time.perf_counter() - start
+    context = state.get("context", {"docs": [], "scores": []})
+    return {"id": case["id"],
+            "question": case["question"],
+            "standalone_question": state.get("standalone_question", case["question"]),
+            "answer": state.get("answer"),
+            "model_tier": state.get("model_tier"),
+            "sources": [{"source": os.path.basename(doc.metadata.get("source", "")), "content": doc.page_content}
+                        for doc in context["docs"]],
+            "scores": context["scores"],
+            "latency": latency,
+            "tokens": {"input": state["input_tokens_count"],
+                       "output": state["output_tokens_count"],
+                       "cache_read": state["cache_read_tokens_count"],
+                       "cache_write": state["cache_write_tokens_count"]},
+            "error": None}
+
+
+def run(rag: Rag, input_file: str, output_file: str, workers: int = 4, max_rpm: float | None = None):
+    cases = read_cases(input_file)
+    completed = read_checkpoint(output_file)
+    pending = [case for case in cases if str(case["id"]) not in completed]
+    logger.info(f"{len(cases)} cases, {len(completed)} already completed, {len(pending)} to run")
+    limiter = RateLimiter(max_rpm)
+
+    def job(case):
+        limiter.wait()
+        try:
+            return run_case(rag, case)
+        except Exception as e:
+            logger.error(f"Case {case['id']} failed: {e}")
+            return {"id": case["id"], "question": case["question"], "error": str(e)}
+
+    failed = 0
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    # failed attempts are kept apart, so that the output has exactly one record per completed case
+    with open(output_file, "a", encoding="utf-8") as out, open(errors_file(output_file), "a", encoding="utf-8") as errors, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(job, case) for case in pending]
+        for i, future in enumerate(as_completed(futures)):
+            result = future.result()
+            failed += result["error"] is not None
+            target = out if result["error"] is None else errors
+            target.write(json.dumps(result, ensure_ascii=False) + "\n")
+            target.flush()
+            if (i + 1) % 10 == 0 or i + 1 == len(futures):
+                logger.info(f"{i + 1}/{len(futures)} cases run ({failed} failed)")
+    return failed
+
+
+class StoredVectorEmbedding(Embeddings):
+    """
+    Offline stand-in for the embedder that reuses the vectors of the retriever's store: a text is embedded
+    as the stored vector of the chunk sharing the most words with it, so that retrieval returns real hits
+    (and the generator, the router and the token accounting run) without calling Bedrock.
+    """
+
+    def __init__(self, retriever, fallback: Embeddings):
+        self.retriever = retriever
+        self.fallback = fallback
+        self.__words__ = None
+
+    @staticmethod
+    def words(text: str) -> set[str]:
+        return set(re.findall(r"\w{3,}", text.lower()))
+
+    def embed_query(self, text: str) -> list[float]:
+        index, store = self.retriever.index, self.retriever.vector_store.store
+        if len(index) == 0:
+            return self.fallback.embed_query(text)
+        if self.__words__ is None or len(self.__words__) != len(index):
+            self.__words__ = [self.words(store[doc_id]["text"]) for doc_id in index.ids]
+        words = self.words(text)
+        best = max(range(len(index)), key=lambda row: len(words & self.__words__[row]))
+        return index.vectors([best])[0].tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class StubChatModel(FakeListChatModel):
+    """FakeListChatModel reporting an estimated token usage, so that the token accounting runs offline."""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        message = result.generations[0].message
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        output_tokens = len(message.content) // 4
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                  "total_tokens": input_tokens + output_tokens}
+        return result
+
+
+def stub_models(embedding_size: int) -> dict:
+    """Local stand-ins for the Bedrock models: no network access, deterministic outputs."""
+    llm = StubChatModel(responses=["Risposta di prova basata sulle fonti [1]."])
+    return {"model": llm, "model_pro": llm, "model_low": llm, "model_ultralow": llm,
+            "embedder": DeterministicFakeEmbedding(size=embedding_size)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL of questions through the RAG pipeline.")
+    parser.add_argument('--settings', action="store", dest='settings_file', default='settings.yaml')
+    parser.add_argument('--input', action="store", dest='input_file', required=True)
+    parser.add_argument('--output', action="store", dest='output_file', required=True)
+    parser.add_argument('--workers', action="store", dest='workers', default=4, type=int)
+    parser.add_argument('--max-rpm', action="store", dest='max_rpm', default=None, type=float, help="cases started per minute (each case makes up to 4 model calls)")
+    parser.add_argument('--stub-models', action="store_true", dest='stub_models', help="use local stand-in models instead of Bedrock")
+    parser.add_argument('--stub-embedding-size', action="store", dest='stub_embedding_size', default=1024, type=int)
+    parser.add_argument('--debug', action="store_true", dest='debug')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', force=True)
+    input_file, output_file = os.path.abspath(args.input_file), os.path.abspath(args.output_file)
+    with open(args.settings_file) as stream:
+        config = yaml.safe_load(stream)
+    os.chdir(os.path.abspath(os.path.dirname(args.settings_file)))
+    settings = rag_settings(config)
+    if args.stub_models:
+        settings.update(stub_models(args.stub_embedding_size))
+        settings["client"] = {"prewarm-connections": 0, "health-interval": 0}
+    rag = Rag(session=Session(), **settings)
+    if args.stub_models:
+        rag.retriever.embeddings = StoredVectorEmbedding(rag.retriever, fallback=settings["embedder"])
+    failed = run(rag, input_file, output_file, workers=args.workers, max_rpm=args.max_rpm)
+    sys.exit(1 if failed > 0 else 0)
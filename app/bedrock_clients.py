@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from boto3 import Session
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+CREDENTIAL_ERRORS = {"ExpiredTokenException", "ExpiredToken", "UnrecognizedClientException",
+                     "InvalidSignatureException", "InvalidClientTokenId"}
+# e.g. credentials without the MFA condition required by the policy (the role must allow bedrock:ListAsyncInvokes)
+ACCESS_ERRORS = {"AccessDeniedException"}
+
+
+class ClientProxy:
+    """Stand-in for the bedrock-runtime client handed to the models, always forwarding to the manager's current client."""
+
+    def __init__(self, manager):
+        self.__manager__ = manager
+
+    def __getattr__(self, name):
+        return getattr(self.__manager__.client, name)
+
+
+class BedrockClientManager:
+    """
+    Owns the bedrock-runtime client shared by the chat models and the embedder.
+    The client is built with a large, keep-alive connection pool, which is pre-warmed with a few
+    concurrent lightweight calls so that the first requests do not pay for the TLS handshakes.
+    A background thread probes the endpoint periodically, which also keeps the pooled connections
+    from going cold during idle periods.
+    On credential refresh the new client is built and warmed up before replacing the current one
+    (the models hold a ClientProxy, so they switch to it without being rebuilt).
+    Temporary credentials (e.g. the MFA session token) are replaced refresh_margin seconds before they
+    expire, and whenever the endpoint rejects them, with a session from the default credential chain
+    (whose providers, e.g. assumed roles or instance profiles, botocore already refreshes by itself),
+    provided that the new credentials pass the probes: otherwise the current client is kept.
+    """
+
+    def __init__(self, session: Session, region: str | None = None, endpoint_url: str | None = None,
+                 max_pool_connections: int = 50, tcp_keepalive: bool = True, connect_timeout: float = 5,
+                 read_timeout: float = 60, max_attempts: int = 2, prewarm_connections: int = 4,
+                 health_interval: float = 60, refresh_margin: float = 60):
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.config = Config(max_pool_connections=max_pool_connections,
+                             tcp_keepalive=tcp_keepalive,
+                             connect_timeout=connect_timeout,
+                             read_timeout=read_timeout,
+                             retries={"max_attempts": max_attempts, "mode": "standard"})
+        self.prewarm_connections = prewarm_connections
+        self.health_interval = health_interval
+        self.refresh_margin = refresh_margin
+        self.expiration = None
+        self.health = {"healthy": None, "latency": None, "error": None, "timestamp": None}
+        self.proxy = ClientProxy(self)
+        self.__lock__ = threading.Lock()
+        self.__swap_lock__ = threading.RLock()  # one client replacement (build, warm-up, swap) at a time
+        self.__generation__ = 0  # number of client replacements, to discard refreshes decided on a replaced client
+        self.__stop__ = threading.Event()
+        self.client = self.__build__(session)
+        # the first warm-up runs with the health checks, so that it does not delay the start-up
+        self.__thread__ = threading.Thread(target=self.__run__, name="bedrock-health", daemon=True)
+        self.__thread__.start()
+
+    @classmethod
+    def from_config(cls, session: Session, config: dict | None, region: str | None = None):
+        config = config or {}
+        return cls(session, region=region,
+                   endpoint_url=config.get("endpoint-url", None),
+                   max_pool_connections=config.get("max-pool-connections", 50),
+                   tcp_keepalive=config.get("tcp-keepalive", True),
+                   connect_timeout=config.get("connect-timeout", 5),
+                   read_timeout=config.get("read-timeout", 60),
+                   max_attempts=config.get("max-attempts", 2),
+                   prewarm_connections=config.get("prewarm-connections", 4),
+                   health_interval=config.get("health-interval", 60),
+                   refresh_margin=config.get("refresh-margin", 60))
+
+    def __build__(self, session: Session):
+        return session.client("bedrock-runtime", region_name=self.region, endpoint_url=self.endpoint_url, config=self.config)
+
+    def probe(self, client=None) -> dict:
+        """
+        One lightweight call to the endpoint. Any HTTP response means the endpoint is reachable,
+        unless the credentials are rejected or denied access.
+        """
+        client = client if client is not None else self.client
+        start = time.perf_counter()
+        error, credentials_rejected = None, False
+        try:
+            client.list_async_invokes(maxResults=1)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in CREDENTIAL_ERRORS:
+                error, credentials_rejected = f"credentials rejected: {code}", True
+            elif code in ACCESS_ERRORS:
+                error = f"access denied: {code}"
+        except BotoCoreError as e:
+            error = str(e)
+        return {"healthy": error is None, "latency": time.perf_counter() - start, "error": error,
+                "credentials_rejected": credentials_rejected, "timestamp": time.time()}
+
+    def prewarm(self, client=None, connections: int | None = None) -> list[dict]:
+        """Open up to prewarm_connections pooled connections at once, returns the results of the probes."""
+        connections = self.prewarm_connections if connections is None else connections
+        if connections <= 0:
+            return []
+        client = client if client is not None else self.client
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            results = list(pool.map(lambda _: self.probe(client), range(connections)))
+        logger.info(f"Bedrock client pre-warmed: {sum(result['healthy'] for result in results)}/{connections} connections, "
+                    f"slowest probe {max(result['latency'] for result in results) * 1e3:.0f} ms")
+        return results
+
+    def swap(self, session: Session, expiration: datetime | None = None, validate: bool = False):
+        """
+        Replace the client with one built from the new session, warming it up before it takes any traffic.
+        expiration is the expiry time of temporary credentials, which are then refreshed before it.
+        With validate, the client is only replaced if at least one probe succeeded and none was refused
+        because of the credentials; returns the replaced client, None if the new one was discarded.
+        """
+        with self.__swap_lock__:
+            client = self.__build__(session)
+            results = self.prewarm(client, connections=max(self.prewarm_connections, 1) if validate else None)
+            if validate:
+                errors = [result["error"] for result in results if result["credentials_rejected"] or
+                          (result["error"] or "").startswith("access denied")]
+                if errors or not any(result["healthy"] for result in results):
+                    errors = errors or [result["error"] for result in results]
+                    logger.warning(f"New Bedrock client discarded: {errors[0] if errors else 'no probe'}")
+                    return None
+            with self.__lock__:
+                old, self.client = self.client, client
+                self.expiration = expiration
+                self.__generation__ += 1
+        # requests already running on the old client keep their connections until they complete
+        logger.info("Bedrock client replaced")
+        return old
+
+    def refresh(self, reason: str, generation: int | None = None) -> bool:
+        """
+        Switch to a session from the default credential chain, if it works. A refresh decided on a client
+        that has been replaced in the meantime (e.g. by a new MFA login) is skipped.
+        """
+        with self.__swap_lock__:
+            if generation is not None and generation != self.__generation__:
+                logger.debug("Bedrock credential refresh skipped, the client was replaced in the meantime")
+                return False
+            logger.info(f"Refreshing Bedrock credentials: {reason}")
+            try:
+                refreshed = self.swap(Session(), validate=True) is not None
+            except Exception as e:
+                logger.warning(f"New Bedrock client discarded: {e}")
+                refreshed = False
+            if not refreshed:
+                logger.error("Bedrock credential refresh failed, the current credentials are kept: a new MFA login is needed")
+            return refreshed
+
+    def __expiring__(self) -> bool:
+        return self.expiration is not None and \
+            datetime.now(timezone.utc) >= self.expiration - timedelta(seconds=self.refresh_margin)
+
+    def check(self) -> dict:
+        generation = self.__generation__
+        if self.__expiring__():
+            self.refresh(f"temporary credentials expire at {self.expiration.isoformat()}", generation)
+            generation = self.__generation__
+        health = self.probe()
+        if health["healthy"] != self.health["healthy"] or not health["healthy"]:
+            log = logger.info if health["healthy"] else logger.warning
+            log(f"Bedrock endpoint {'healthy' if health['healthy'] else 'unhealthy: ' + str(health['error'])} "
+                f"({health['latency'] * 1e3:.0f} ms)")
+        self.health = health
+        if health["credentials_rejected"]:
+            self.refresh(health["error"], generation)
+        return health
+
+    def __run__(self):
+        try:
+            self.prewarm()
+        except Exception as e:
+            logger.warning(f"Bedrock client pre-warm failed: {e}")
+        if self.health_interval <= 0:
+            return
+        # checks are frequent enough to refresh expiring credentials within the margin
+        interval = min(self.health_interval, self.refresh_margin / 2) if self.refresh_margin > 0 else self.health_interval
+        while not self.__stop__.wait(interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning(f"Bedrock health check failed: {e}")
+
+    def close(self):
+        self.__stop__.set()
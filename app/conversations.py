@@ -0,0 +1,84 @@
+import logging
+import re
+import textwrap
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CITATION_PATTERN = re.compile(r"(<sup>)?\[[\d,\s]*\](</sup>)?")
+
+
+def summarize_turn(question: str, answer: str, max_chars: int = 600) -> str:
+    """Compact a conversation turn: the standalone question already carries the previous context,
+    the answer is stripped of its citations and shortened."""
+    answer = CITATION_PATTERN.sub("", answer)
+    return f"user: {question}\nai: {textwrap.shorten(answer, width=max_chars, placeholder=' ...')}"
+
+
+class ConversationStore:
+    """
+    Server-side conversation state, keyed by the Gradio session hash.
+    Each session keeps a rolling summary updated from the newest turn only, so that the cost of
+    consolidating a follow-up question does not grow with the length of the conversation.
+    Sessions idle for more than ttl seconds are evicted, as well as the least recently used ones
+    beyond max_sessions.
+    """
+
+    def __init__(self, ttl: int = 1800, max_sessions: int = 1000, summary_max_chars: int = 600):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.summary_max_chars = summary_max_chars
+        self.__sessions__ = OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict | None):
+        config = config or {}
+        return cls(ttl=config.get("ttl-seconds", 1800),
+                   max_sessions=config.get("max-sessions", 1000),
+                   summary_max_chars=config.get("summary-max-chars", 600))
+
+    def __evict__(self, now: float):
+        while self.__sessions__:
+            session_hash, entry = next(iter(self.__sessions__.items()))
+            if now - entry["last_access"] > self.ttl or len(self.__sessions__) > self.max_sessions:
+                self.__sessions__.pop(session_hash)
+                logger.debug(f"Conversation state of session {session_hash} evicted")
+            else:
+                break
+
+    def get(self, session_hash: str, turns: int, last_question: str) -> str | None:
+        """
+        Rolling summary of the session, if it matches the conversation shown to the user
+        (same number of user turns, same last question). Returns None otherwise, e.g. after
+        eviction, a restart of the server or when the user switches to another saved conversation.
+        """
+        now = time.time()
+        with self.__lock__:
+            self.__evict__(now)
+            entry = self.__sessions__.get(session_hash)
+            if entry is None or entry["turns"] != turns or entry["last_question"] != last_question:
+                return None
+            entry["last_access"] = now
+            self.__sessions__.move_to_end(session_hash)
+            return entry["summary"]
+
+    def update(self, session_hash: str, turns: int, last_question: str, standalone_question: str, answer: str):
+        """Replace the summary of the session with the newest turn, which already folds the previous summary in."""
+        now = time.time()
+        with self.__lock__:
+            self.__sessions__[session_hash] = {"summary": summarize_turn(standalone_question, answer, self.summary_max_chars),
+                                               "turns": turns,
+                                               "last_question": last_question,
+                                               "last_access": now}
+            self.__sessions__.move_to_end(session_hash)
+            self.__evict__(now)
+
+    def drop(self, session_hash: str):
+        with self.__lock__:
+            self.__sessions__.pop(session_hash, None)
+
+    def __len__(self):
+        return len(self.__sessions__)
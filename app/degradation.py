@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+# service modes, from the normal one to the most degraded; each mode also applies the steps before it
+MODES = ["normal", "no-query-aug", "no-consolidation", "cheaper-tier", "shedding"]
+
+DEFAULT_LATENCY_STEPS = [10, 20, 30, 45]  # p95 seconds of a model tier to enter each degraded mode
+DEFAULT_ERROR_STEPS = [0.1, 0.25, 0.4, 0.6]  # error rate of a model tier to enter each degraded mode
+
+
+class DegradationController:
+    """
+    Graceful degradation of the chat endpoint when the language models slow down or fail.
+    LanguageModel.generate reports the start and the outcome of each call per tier; the worst tier
+    over the rolling window sets the service mode, which progressively disables query augmentation,
+    skips the history consolidation, moves generation to the fallback tier and finally rejects requests.
+    The mode gets worse as soon as the thresholds are crossed, and improves one step at a time after
+    cooldown seconds without changes. Requests beyond max_in_flight are rejected in any mode.
+    Calls still running count with their elapsed time once it exceeds the first latency step,
+    so that hung calls (e.g. waiting for the read timeout and its retries) degrade the mode before they end.
+    """
+
+    def __init__(self, enabled: bool = True,
+                 window: float = 120,
+                 min_samples: int = 5,
+                 latency_steps: list[float] | None = None,
+                 error_steps: list[float] | None = None,
+                 cooldown: float = 60,
+                 fallback_tier: str = "low",
+                 max_in_flight: int = 16,
+                 retry_after: int = 60):
+        self.enabled = enabled
+        self.window = window
+        self.min_samples = min_samples
+        self.latency_steps = latency_steps or DEFAULT_LATENCY_STEPS
+        self.error_steps = error_steps or DEFAULT_ERROR_STEPS
+        for steps in (self.latency_steps, self.error_steps):
+            if len(steps) != len(MODES) - 1:
+                raise ValueError(f"Degradation steps must have {len(MODES) - 1} thresholds, one for each of {MODES[1:]}")
+        self.cooldown = cooldown
+        self.fallback_tier = fallback_tier
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.level = 0
+        self.changed_at = time.monotonic()
+        self.in_flight = 0
+        self.rejected = 0
+        self.__samples__ = defaultdict(lambda: deque(maxlen=1000))
+        self.__running__ = {}  # call id -> (tier, start time)
+        self.__calls__ = 0
+        self.__lock__ = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict | None):
+        config = config or {}
+        return cls(enabled=config.get("enabled", True),
+                   window=config.get("window-seconds", 120),
+                   min_samples=config.get("min-samples", 5),
+                   latency_steps=config.get("latency-steps"),
+                   error_steps=config.get("error-steps"),
+                   cooldown=config.get("cooldown-seconds", 60),
+                   fallback_tier=config.get("fallback-tier", "low"),
+                   max_in_flight=config.get("max-in-flight", 16),
+                   retry_after=config.get("retry-after-seconds", 60))
+
+    @property
+    def mode(self) -> str:
+        return MODES[self.level]
+
+    @staticmethod
+    def applies(mode: str | None, step: str) -> bool:
+        """Whether the degradation step is active in the given mode."""
+        return MODES.index(mode or "normal") >= MODES.index(step)
+
+    def record(self, tier: str, latency: float, ok: bool = True):
+        now = time.monotonic()
+        with self.__lock__:
+            self.__samples__[tier].append((now, latency, ok))
+            self.__update__(now)
+
+    def start(self, tier: str) -> int:
+        """Register a call to the tier, returns its id to pass to finish()."""
+        with self.__lock__:
+            self.__calls__ += 1
+            self.__running__[self.__calls__] = (tier, time.monotonic())
+            return self.__calls__
+
+    def finish(self, call: int, ok: bool = True):
+        with self.__lock__:
+            tier, start = self.__running__.pop(call)
+            now = time.monotonic()
+            self.__samples__[tier].append((now, now - start, ok))
+            self.__update__(now)
+
+    def stats(self) -> dict:
+        """p95 latency, error rate and number of calls of each tier over the rolling window."""
+        now = time.monotonic()
+        with self.__lock__:
+            return self.__stats__(now)
+
+    def __stats__(self, now: float) -> dict:
+        stats = {}
+        hung = defaultdict(list)
+        for tier, start in self.__running__.values():
+            if now - start >= self.latency_steps[0]:
+                hung[tier].append((now, now - start, True))
+        for tier in set(self.__samples__) | set(hung):
+            samples = self.__samples__[tier]
+            while samples and now - samples[0][0] > self.window:
+                samples.popleft()
+            samples = list(samples) + hung[tier]
+            if not samples:
+                continue
+            latencies = sorted(latency for _, latency, ok in samples if ok)
+            stats[tier] = {"p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+                           "error_rate": sum(not ok for _, _, ok in samples) / len(samples),
+                           "calls": len(samples),
+                           "hung": len(hung[tier])}
+        return stats
+
+    def __target__(self, now: float) -> int:
+        target = 0
+        for tier, tier_stats in self.__stats__(now).items():
+            if tier_stats["calls"] < self.min_samples:
+                continue
+            for level, (max_latency, max_error_rate) in enumerate(zip(self.latency_steps, self.error_steps), start=1):
+                slow = tier_stats["p95"] is not None and tier_stats["p95"] >= max_latency
+                if slow or tier_stats["error_rate"] >= max_error_rate:
+                    target = max(target, level)
+        return target
+
+    def __update__(self, now: float):
+        if not self.enabled:
+            return
+        target = self.__target__(now)
+        if target > self.level:
+            self.__set_level__(target, now)
+        elif target < self.level and now - self.changed_at >= self.cooldown:
+            self.__set_level__(self.level - 1, now)
+
+    def __set_level__(self, level: int, now: float):
+        log = logger.warning if level > self.level else logger.info
+        log(f"Service mode changed from '{MODES[self.level]}' to '{MODES[level]}' ({self.__stats__(now)})")
+        self.level = level
+        self.changed_at = now
+
+    def admit(self) -> str:
+        """
+        Mode to serve a new request with, "shedding" if it must be rejected.
+        Every admitted request must be followed by a call to release().
+        """
+        with self.__lock__:
+            self.__update__(time.monotonic())
+            if self.mode == "shedding" or (self.enabled and self.in_flight >= self.max_in_flight):
+                self.rejected += 1
+                return "shedding"
+            self.in_flight += 1
+            return self.mode
+
+    def release(self):
+        with self.__lock__:
+            self.in_flight -= 1
+
+    def status(self) -> str:
+        return f"{self.mode} ({self.in_flight} in flight, {self.rejected} rejected)"
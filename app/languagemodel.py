@@ -1,6 +1,7 @@
 from typing import Literal
 
 from langchain_aws import ChatBedrockConverse
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages.base import BaseMessage
 from langchain_core.messages.system import SystemMessage
 from langchain_core.messages.human import HumanMessage
@@ -20,17 +21,44 @@ noSystemPromptModels = [
     "mistral.mixtral-8x7b-instruct-v0:1"
 ]
 
-def __instantiateLLM__(model: ChatBedrockConverse | str, client):
-    if type(model) is ChatBedrockConverse:
+# models supporting Bedrock prompt caching (cachePoint blocks in Converse), with the minimum number of tokens
+# a cache checkpoint must cover: shorter prefixes are neither written to nor read from the cache
+promptCachingModels = {
+    "anthropic.claude-3-7-sonnet-20250219-v1:0": 1024,
+    "anthropic.claude-3-5-haiku-20241022-v1:0": 2048,
+    "anthropic.claude-sonnet-4-20250514-v1:0": 1024,
+    "amazon.nova-pro-v1:0": 1000,
+    "amazon.nova-lite-v1:0": 1000,
+    "amazon.nova-micro-v1:0": 1000,
+}
+
+CROSS_REGION_PREFIXES = ("eu.", "us.", "apac.", "us-gov.")
+
+def base_model_id(model_id: str | None) -> str | None:
+    """Model id without the cross-region inference profile prefix (e.g. eu.anthropic... -> anthropic...)."""
+    if model_id is not None and model_id.startswith(CROSS_REGION_PREFIXES):
+        return model_id.split(".", 1)[1]
+    return model_id
+
+def approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+def __instantiateLLM__(model: BaseChatModel | str, client):
+    # any chat model instance is accepted as is (e.g. local stand-in models for offline runs)
+    if isinstance(model, BaseChatModel):
         return model
     else:
         return ChatBedrockConverse(model_id=model, client=client)
 
 class LanguageModel:
-    def __init__(self, model: ChatBedrockConverse | str, client=None, model_pro: ChatBedrockConverse | str | None = None, model_low: ChatBedrockConverse | str | None = None,):
+    def __init__(self, model: ChatBedrockConverse | str, client=None, model_pro: ChatBedrockConverse | str | None = None, model_low: ChatBedrockConverse | str | None = None,
+                 model_ultralow: ChatBedrockConverse | str | None = None, monitor=None):
+        # optional observer of the start and outcome of each call, see DegradationController.start and finish
+        self.monitor = monitor
         self.llm = __instantiateLLM__(model, client)
         self.llm_pro = __instantiateLLM__(model_pro, client) if model_pro is not None else __instantiateLLM__(model, client)
         self.llm_low = __instantiateLLM__(model_low, client) if model_low is not None else __instantiateLLM__(model, client)
+        self.llm_ultralow = __instantiateLLM__(model_ultralow, client) if model_ultralow is not None else self.llm_low
 
     def __sanitize_msgs__(self, messages: list[BaseMessage]):
         i = 0
@@ -41,12 +69,42 @@ class LanguageModel:
             i += 1
         return messages
 
-    def generate(self, messages: list[BaseMessage], level: Literal["standard","pro","low"]="standard",**kwargs)->AIMessage:
-        llm = self.llm_pro if level == "pro" else self.llm_low if level == "low" else self.llm
+    def __add_cache_point__(self, messages: list[BaseMessage], min_tokens: int = 0):
+        # the leading system messages are static across calls: mark the end of this prefix as cacheable,
+        # provided it is long enough for the model to cache it
+        prefix_end = 0
+        while prefix_end < len(messages) and type(messages[prefix_end]) is SystemMessage:
+            prefix_end += 1
+        prefix_tokens = sum(approx_tokens(message.content if type(message.content) is str
+                                          else "".join(block.get("text", "") for block in message.content if type(block) is dict))
+                            for message in messages[:prefix_end])
+        if prefix_tokens < min_tokens:
+            logger.debug(f"Static prefix of ~{prefix_tokens} tokens is below the {min_tokens} tokens needed for prompt caching")
+            return messages
+        if prefix_end > 0:
+            last = messages[prefix_end - 1]
+            content = [{"type": "text", "text": last.content}] if type(last.content) is str else list(last.content)
+            messages[prefix_end - 1] = SystemMessage(content + [ChatBedrockConverse.create_cache_point()])
+        return messages
+
+    def generate(self, messages: list[BaseMessage], level: Literal["standard","pro","low","ultralow"]="standard", cache: bool = False, **kwargs)->AIMessage:
+        llm = self.llm_pro if level == "pro" else self.llm_low if level == "low" else self.llm_ultralow if level == "ultralow" else self.llm
         allowed_keys = ["temperature","max_tokens"]
         llm.__dict__.update((key, value) for key, value in kwargs.items() if key in allowed_keys)
-        if llm.model_id in noSystemPromptModels:
-            generated_message = llm.invoke(self.__sanitize_msgs__(messages))
-        else:
-            generated_message = llm.invoke(messages)
+        model_id = getattr(llm, "model_id", None)
+        # models without system prompt support get the system prompt as a human turn: nothing to cache there
+        if cache and base_model_id(model_id) in promptCachingModels and model_id not in noSystemPromptModels:
+            messages = self.__add_cache_point__(list(messages), promptCachingModels[base_model_id(model_id)])
+        call = self.monitor.start(level) if self.monitor is not None else None
+        try:
+            if model_id in noSystemPromptModels:
+                generated_message = llm.invoke(self.__sanitize_msgs__(messages))
+            else:
+                generated_message = llm.invoke(messages)
+        except Exception:
+            if self.monitor is not None:
+                self.monitor.finish(call, ok=False)
+            raise
+        if self.monitor is not None:
+            self.monitor.finish(call)
         return generated_message
\ No newline at end of file
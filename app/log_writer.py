@@ -0,0 +1,226 @@
+import atexit
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from glob import escape, glob
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    """
+    Single background writer for the append-only logs (like/flag CSVs, evaluations JSONL).
+    Request handlers only enqueue the lines in a bounded in-memory queue and never wait for the disk:
+    if the queue is full the event is dropped and an error is logged.
+    The writer thread appends the queued lines in batches, fsyncs the files periodically,
+    rotates the files larger than max_bytes (compressing the old ones with gzip and keeping the
+    last `backups` of them) and flushes everything on shutdown.
+    """
+
+    def __init__(self, max_queue: int = 10000, flush_interval: float = 1.0, fsync_interval: float = 5.0,
+                 max_bytes: int = 10 * 1024 * 1024, backups: int = 10):
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self.__closing__ = False
+        self.__queue__ = queue.Queue(maxsize=max_queue)
+        self.__last_fsync__ = defaultdict(float)
+        self.__stop__ = threading.Event()
+        self.__thread__ = threading.Thread(target=self.__run__, name="log-writer", daemon=True)
+        self.__thread__.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config: dict | None):
+        config = config or {}
+        return cls(max_queue=config.get("queue-size", 10000),
+                   flush_interval=config.get("flush-interval", 1.0),
+                   fsync_interval=config.get("fsync-interval", 5.0),
+                   max_bytes=config.get("max-bytes", 10 * 1024 * 1024),
+                   backups=config.get("backups", 10))
+
+    def write(self, path: str, line: str, header: str | None = None) -> bool:
+        """Enqueue a line to be appended to path (header is written first if the file is new). Never blocks."""
+        try:
+            self.__queue__.put_nowait((path, line, header))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.error(f"Log queue full, event for {path} dropped ({self.dropped} dropped so far)")
+            return False
+
+    def write_jsonl(self, path: str, data: dict) -> bool:
+        return self.write(path, json.dumps(data) + "\n")
+
+    def write_csv(self, path: str, row: list, header: list | None = None) -> bool:
+        return self.write(path, self.__csv_line__(row), self.__csv_line__(header) if header is not None else None)
+
+    @staticmethod
+    def __csv_line__(row: list) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        return buffer.getvalue()
+
+    def flush(self, timeout: float | None = None):
+        """Wait until all the events enqueued so far are written (for shutdown and offline use)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.__queue__.unfinished_tasks > 0 and self.__thread__.is_alive():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout: float = 10.0):
+        if self.__closing__:
+            return
+        # batches written while closing are fsynced right away
+        self.__closing__ = True
+        self.flush(timeout)
+        self.__stop__.set()
+        self.__thread__.join(timeout)
+
+    def __run__(self):
+        while not self.__stop__.is_set():
+            try:
+                batch = [self.__queue__.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # collect whatever else arrives up to the flush interval, unless closing
+            deadline = time.monotonic() + self.flush_interval
+            while time.monotonic() < deadline and not self.__closing__:
+                try:
+                    batch.append(self.__queue__.get(timeout=min(0.1, max(0.0, deadline - time.monotonic()))))
+                except queue.Empty:
+                    continue
+            while True:
+                try:
+                    batch.append(self.__queue__.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.__write_batch__(batch)
+            except Exception as e:
+                logger.error(f"Log writer failed to write {len(batch)} events: {e}")
+            finally:
+                for _ in batch:
+                    self.__queue__.task_done()
+
+    def __write_batch__(self, batch: list[tuple]):
+        by_path = defaultdict(list)
+        for path, line, header in batch:
+            by_path[path].append((line, header))
+        now = time.monotonic()
+        for path, events in by_path.items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                self.__rotate__(path)
+            is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+            with open(path, "a", encoding="utf-8", newline="") as file:
+                if is_new and events[0][1] is not None:
+                    file.write(events[0][1])
+                file.writelines(line for line, _ in events)
+                file.flush()
+                if now - self.__last_fsync__[path] >= self.fsync_interval or self.__closing__:
+                    os.fsync(file.fileno())
+                    self.__last_fsync__[path] = now
+
+    def __rotate__(self, path: str):
+        rotated = f"{path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.replace(path, rotated)
+        with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(rotated)
+        for old in sorted(glob(f"{escape(path)}.*.gz"))[:-self.backups or None]:
+            os.remove(old)
+        logger.info(f"Log {path} rotated to {rotated}.gz")
+
+
+def read_lines(path: str):
+    """Lines of a log and of its rotated (gzip compressed) copies, oldest first."""
+    for rotated in sorted(glob(f"{escape(path)}.*.gz")):
+        with gzip.open(rotated, "rt", encoding="utf-8") as file:
+            yield from file
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            yield from file
+
+
+class JsonSnapshot:
+    """
+    In-memory copy of a JSON log that is rewritten as a whole (token usage, quotas).
+    Request handlers read and update it under a lock, without touching the disk; a background thread
+    writes it back (atomically, through a temporary file) at most every flush_interval seconds when
+    it has changed, and on shutdown.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.__data__ = None
+        self.__dirty__ = False
+        self.__lock__ = threading.RLock()
+        self.__write_lock__ = threading.Lock()  # one writer of the file (and of its temporary copy) at a time
+        self.__stop__ = threading.Event()
+        self.__thread__ = threading.Thread(target=self.__run__, name=f"snapshot-{os.path.basename(path)}", daemon=True)
+        self.__thread__.start()
+        atexit.register(self.close)
+
+    def __load__(self) -> dict:
+        if self.__data__ is None:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as file:
+                    self.__data__ = json.load(file)
+            else:
+                self.__data__ = {}
+        return self.__data__
+
+    def read(self, function):
+        """Result of function applied to the data (which it must not modify nor keep)."""
+        with self.__lock__:
+            return function(self.__load__())
+
+    def update(self, function):
+        """Result of function applied to the data, which it can modify in place."""
+        with self.__lock__:
+            result = function(self.__load__())
+            self.__dirty__ = True
+            return result
+
+    def flush(self):
+        with self.__write_lock__:
+            with self.__lock__:
+                if not self.__dirty__:
+                    return
+                content = json.dumps(self.__data__, indent=4)
+                self.__dirty__ = False
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+
+    def __run__(self):
+        while not self.__stop__.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write {self.path}: {e}")
+
+    def close(self, timeout: float = 10.0):
+        # stop the background writer before the final flush
+        self.__stop__.set()
+        self.__thread__.join(timeout)
+        self.flush()
@@ -0,0 +1,144 @@
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler for the request handlers.
+    When enabled, a fraction (sample_rate) of the calls of the wrapped functions is profiled: a background
+    thread samples the stack of the threads serving those calls every interval seconds and aggregates
+    the stacks, which can be exported in the folded format used by flamegraph.pl, speedscope and the like.
+    When disabled, the wrapped function costs one attribute check per call.
+    """
+
+    def __init__(self, enabled: bool = False, sample_rate: float = 0.1, interval: float = 0.005,
+                 output_folder: str = "logs/profiles"):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.output_folder = output_folder
+        self.enabled = False
+        self.stacks = Counter()
+        self.profiled_calls = 0
+        self.__active__ = {}  # thread id -> name of the profiled call
+        self.__lock__ = threading.Lock()
+        self.__thread__ = None
+        if enabled:
+            self.enable()
+
+    @classmethod
+    def from_config(cls, config: dict | None, enabled: bool | None = None):
+        config = config or {}
+        return cls(enabled=config.get("enabled", False) if enabled is None else enabled,
+                   sample_rate=config.get("sample-rate", 0.1),
+                   interval=config.get("interval", 0.005),
+                   output_folder=config.get("output-folder", "logs/profiles"))
+
+    def enable(self, sample_rate: float | None = None):
+        with self.__lock__:
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            self.enabled = True
+            if self.__thread__ is None or not self.__thread__.is_alive():
+                self.__thread__ = threading.Thread(target=self.__run__, name="profiler", daemon=True)
+                self.__thread__.start()
+        logger.info(f"Profiling enabled on {self.sample_rate:.0%} of the requests")
+
+    def disable(self):
+        self.enabled = False
+        logger.info(f"Profiling disabled ({self.profiled_calls} calls, {sum(self.stacks.values())} samples collected)")
+
+    def sampled(self, function):
+        """Decorator profiling a fraction of the calls of function while the profiler is enabled."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.enabled or random.random() >= self.sample_rate:
+                return function(*args, **kwargs)
+            thread_id = threading.get_ident()
+            self.__active__[thread_id] = function.__name__
+            self.profiled_calls += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__active__.pop(thread_id, None)
+        return wrapper
+
+    @staticmethod
+    def __fold__(name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join([name] + frames[::-1])
+
+    def __run__(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self.__active__:
+                continue
+            frames = sys._current_frames()
+            for thread_id, name in list(self.__active__.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.stacks[self.__fold__(name, frame)] += 1
+
+    def export(self) -> str | None:
+        """Write the stacks aggregated so far in folded format ("frame;frame;frame count" lines), returns the file path."""
+        stacks = self.stacks.copy()
+        if not stacks:
+            logger.warning("No profiling samples to export.")
+            return None
+        os.makedirs(self.output_folder, exist_ok=True)
+        path = os.path.join(self.output_folder, f"profile_{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        logger.info(f"Profile with {sum(stacks.values())} samples from {self.profiled_calls} calls exported to {path}")
+        return path
+
+    def reset(self):
+        self.stacks.clear()
+        self.profiled_calls = 0
+
+    def status(self) -> str:
+        state = f"enabled on {self.sample_rate:.0%} of the requests" if self.enabled else "disabled"
+        return f"{state} ({self.profiled_calls} calls, {sum(self.stacks.values())} samples collected)"
+
+
+def benchmark(calls: int = 200000):
+    """Overhead of the profiler wrapper on a trivial function, when disabled and when enabled but not sampling."""
+    def handler(x):
+        return x
+
+    def timed(function) -> float:
+        start = time.perf_counter()
+        for i in range(calls):
+            function(i)
+        return (time.perf_counter() - start) / calls
+
+    baseline = min(timed(handler) for _ in range(5))
+    profiler = SamplingProfiler(enabled=False)
+    disabled = min(timed(profiler.sampled(handler)) for _ in range(5))
+    profiler.enable(sample_rate=0.0)
+    not_sampled = min(timed(profiler.sampled(handler)) for _ in range(5))
+    profiler.disable()
+    print(f"plain call: {baseline * 1e9:.0f} ns")
+    print(f"profiler disabled: {disabled * 1e9:.0f} ns (+{(disabled - baseline) * 1e9:.0f} ns per request)")
+    print(f"profiler enabled, call not sampled: {not_sampled * 1e9:.0f} ns (+{(not_sampled - baseline) * 1e9:.0f} ns per request)")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure the per-request overhead of the sampling profiler.")
+    parser.add_argument("--calls", type=int, default=200000)
+    bench_args = parser.parse_args()
+    benchmark(bench_args.calls)
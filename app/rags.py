@@ -5,14 +5,19 @@ from langchain_aws import BedrockEmbeddings, InMemoryVectorStore, ChatBedrockCon
 from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 import logging
+from bedrock_clients import BedrockClientManager
 from languagemodel import LanguageModel
 from retriever import Retriever
+from router import ModelRouter, TIERS
+from degradation import DegradationController
 from langgraph.graph import StateGraph, END
 from langgraph.types import Command
 from langchain_core.messages.human import HumanMessage
 from typing_extensions import List, TypedDict
 import textwrap
+from datetime import datetime
 import json
+import os
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -32,26 +37,58 @@ def messages_to_history_str(messages: list[BaseMessage]) -> str:
     return "\n".join(string_messages)
 
 
+def token_usage(response: BaseMessage, state: dict | None = None) -> dict:
+    """Add the token usage of an LLM response to the counters accumulated in the state.
+    Prompt cache reads/writes are tracked apart from the regular (uncached) input tokens."""
+    state = state if state is not None else {}
+    usage = getattr(response, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    cache_read = details.get("cache_read") or 0
+    cache_write = details.get("cache_creation") or 0
+    return {"input_tokens_count": state.get("input_tokens_count", 0) + max(usage.get("input_tokens", 0) - cache_read - cache_write, 0),
+            "output_tokens_count": state.get("output_tokens_count", 0) + usage.get("output_tokens", 0),
+            "cache_read_tokens_count": state.get("cache_read_tokens_count", 0) + cache_read,
+            "cache_write_tokens_count": state.get("cache_write_tokens_count", 0) + cache_write}
+
+
 class Prompts:
+    # compiled templates are shared by every Prompts instance reading the same file
+    __compiled__: dict[str, dict[str, ChatPromptTemplate]] = {}
+
     def __init__(self, jsonfile: str):
-        with open(jsonfile, 'r') as file:
-            data = json.load(file)
-            for k, v in data.items():
-                self.__setattr__(k, self.__parse__(v))
+        key = os.path.abspath(jsonfile)
+        if key not in Prompts.__compiled__:
+            with open(jsonfile, 'r') as file:
+                data = json.load(file)
+            Prompts.__compiled__[key] = {k: self.__parse__(v) for k, v in data.items()}
+        for k, v in Prompts.__compiled__[key].items():
+            self.__setattr__(k, v)
 
     def __parse__(self, prompt_dicts: List[dict]):
-        return ChatPromptTemplate([(d["role"], d["content"]) for d in prompt_dicts])
+        template = ChatPromptTemplate([(d["role"], d["content"]) for d in prompt_dicts])
+        # messages without variables (e.g. the long system instructions) are rendered once here
+        # and then reused as they are, so that every call sends exactly the same static prefix
+        template.messages = [m.format_messages()[0] if getattr(m, "input_variables", None) == [] else m
+                             for m in template.messages]
+        return template
 
 
 # Define state for application
 class State(TypedDict):
     question: str # the user question
     history: List[BaseMessage] # all the interactions between ai and user
+    summary: str # rolling summary of the previous turns (alternative to the full history, see ConversationStore)
+    standalone_question: str # the user question made standalone by the history consolidation
     context: dict # retrieved documents to use as context source
     additional_context: str = "" # additional info added by the user to be considered a valid source
     query_aug: bool # use or not query augmentation technique before passing the question to the retriever
     input_tokens_count: int # amount of input tokens processed by the whole chain of llm calls triggered in this round
     output_tokens_count: int # amount of output tokens processed by the whole chain of llm calls triggered in this round
+    cache_read_tokens_count: int # amount of input tokens read from the prompt cache in this round
+    cache_write_tokens_count: int # amount of input tokens written to the prompt cache in this round
+    history_depth: int # amount of previous user interactions in the conversation
+    model_tier: str # language model tier used to generate the answer
+    degradation: str # service mode the request is served with (see DegradationController)
     answer: str # textual answer generated by the system and returned to the user
 
 
@@ -66,10 +103,21 @@ class Rag:
                  **kwargs):
         self.prompts = Prompts(kwargs.get("promptfile", "./prompts.json"))
         self.session = session
-        client = session.client("bedrock-runtime", region_name=kwargs.get("region"))
+        self.degradation = DegradationController.from_config(kwargs.get("degradation", None))
+        self.clients = BedrockClientManager.from_config(session, kwargs.get("client", None), region=kwargs.get("region"))
+        client = self.clients.proxy
         self.llm = LanguageModel(model, client=client, model_low=kwargs.get("model_low", None),
-                                 model_pro=kwargs.get("model_pro", None))
-        self.retriever = Retriever(embedder, vector_store=vector_store, client=client)
+                                 model_pro=kwargs.get("model_pro", None),
+                                 model_ultralow=kwargs.get("model_ultralow", None),
+                                 monitor=self.degradation)
+        self.router = ModelRouter.from_config(kwargs.get("routing", None))
+        self.retrieval = kwargs.get("retrieval", None) or {}
+        self.retriever = Retriever(embedder, vector_store=vector_store, client=client,
+                                   chunk_size=kwargs.get("chunk_size", 500),
+                                   chunk_overlap=kwargs.get("chunk_overlap", 100),
+                                   parent_chunk_size=kwargs.get("parent_chunk_size", None),
+                                   parent_token_budget=kwargs.get("parent_token_budget", 3000),
+                                   quantization=kwargs.get("quantization", None))
         graph_builder = StateGraph(State)
         graph_builder.set_entry_point("orchestrator")
         graph_builder.add_node("orchestrator", self.orchestrator)
@@ -79,24 +127,37 @@ class Rag:
         graph_builder.add_node("generator", self.generator)
         self.graph = graph_builder.compile()
 
+    def update_session(self, session: Session, expiration: datetime | None = None):
+        """Switch to new credentials (e.g. after MFA) without rebuilding the models and the vector store.
+        Temporary credentials are refreshed before their expiration (see BedrockClientManager)."""
+        self.session = session
+        self.clients.swap(session, expiration=expiration)
+
     def generate_norag(self, input: str):
         messages = self.prompts.question_open.invoke({"question": input}).messages
         response = self.llm.generate(messages=messages)
-        return {"answer": response.content,
-                "input_tokens_count": response.usage_metadata["input_tokens"],
-                "output_tokens_count": response.usage_metadata["output_tokens"]}
+        return {"answer": response.content, **token_usage(response)}
 
     def orchestrator(self, state: State) -> Command[Literal["augmentator", "doc_retriever", "history_consolidator"]]:
         logger.debug(f"Dispatching request: {state}")
         previous_user_interactions = [message for message in state["history"] if type(message) is HumanMessage]
-        if len(previous_user_interactions) > 0:
+        mode = state.get("degradation")
+        if (len(previous_user_interactions) > 0 or state.get("summary")) and not DegradationController.applies(mode, "no-consolidation"):
             return Command(goto="history_consolidator")
         else:
-            return Command(goto="augmentator" if state["query_aug"] else "doc_retriever")
+            query_aug = state["query_aug"] and not DegradationController.applies(mode, "no-query-aug")
+            return Command(goto="augmentator" if query_aug else "doc_retriever")
 
     def doc_retriever(self, state: State) -> Command[Literal["generator", END]]:
         logger.debug(f"New retrieval: {state}")
-        retrieved_docs, scores = self.retriever.retrieve_with_scores(state["question"], n=10, score_threshold=0.6)
+        n = self.retrieval.get("n", 10)
+        score_threshold = self.retrieval.get("score-threshold", 0.6)
+        if self.retrieval.get("strategy", "similarity") == "mmr":
+            retrieved_docs, scores = self.retriever.retrieve_diverse_with_scores(state["question"], n=n, score_threshold=score_threshold,
+                                                                                fetch_k=self.retrieval.get("fetch-k", None),
+                                                                                lambda_mult=self.retrieval.get("lambda-mult", 0.5))
+        else:
+            retrieved_docs, scores = self.retriever.retrieve_with_scores(state["question"], n=n, score_threshold=score_threshold)
         logger.debug(f"Retrieved docs: {retrieved_docs}")
         additional_context = state.get("additional_context", None)
         if len(retrieved_docs) == 0 and (type(additional_context) is not str or additional_context == ""):
@@ -117,19 +178,22 @@ class Rag:
             proximal_history = state["history"][-5:]
         else:
             proximal_history = state["history"]
+        # the rolling summary, when available, replaces the full history and keeps the prompt size flat
+        history_str = state.get("summary") or messages_to_history_str(state["history"])
         messages = self.prompts.history_consolidation.invoke({"question": state["question"],
-                                                              "history": messages_to_history_str(
-                                                                  state["history"])}).messages
+                                                              "history": history_str}).messages
         logger.debug(messages)
         logger.debug(proximal_history)
-        response = self.llm.generate(messages=messages)
+        response = self.llm.generate(messages=messages, cache=True)
         consolidated_question = response.content
         logger.debug(f"Consolidated query: {textwrap.shorten(consolidated_question, width=30)}")
         return Command(
             update={"question": consolidated_question,
+                    "standalone_question": consolidated_question,
                     "history": [],
-                    "input_tokens_count": state["input_tokens_count"] + response.usage_metadata["input_tokens"],
-                    "output_tokens_count": state["output_tokens_count"] + response.usage_metadata["output_tokens"]},
+                    "summary": "",
+                    "history_depth": state.get("history_depth") or len([message for message in state["history"] if type(message) is HumanMessage]),
+                    **token_usage(response, state)},
             goto="orchestrator",
         )
 
@@ -141,9 +205,7 @@ class Rag:
         logger.debug(f"Expanded query: {textwrap.shorten(augmented_question, width=30)}")
         return Command(
             update={"question": augmented_question,
-                    "input_tokens_count": state["input_tokens_count"] + response.usage_metadata["input_tokens"],
-                    "output_tokens_count": state["output_tokens_count"] + response.usage_metadata["output_tokens"]
-                    },
+                    **token_usage(response, state)},
             goto="doc_retriever",
         )
 
@@ -157,10 +219,21 @@ class Rag:
             doc_strings.append(f"Source [0]:\n{additional_context}")
         docs_content = "\n".join(doc_strings)
         messages = self.prompts.question_with_context_inline_cit.invoke({"question": state["question"], "context": docs_content}).messages
-        response = self.llm.generate(messages=messages, level="pro")
+        tier = self.router.route(state)
+        degraded = DegradationController.applies(state.get("degradation"), "cheaper-tier")
+        if degraded and TIERS.index(self.degradation.fallback_tier) < TIERS.index(tier):
+            logger.info(f"Degraded service: generating with tier '{self.degradation.fallback_tier}' instead of '{tier}'")
+            tier = self.degradation.fallback_tier
+        response = self.llm.generate(messages=messages, level=tier, cache=True)
+        usage = token_usage(response, state)
+        if not degraded and self.router.needs_escalation(tier, response.content, len(doc_strings)):
+            logger.info(f"Answer from tier '{tier}' failed the quality check, escalating to '{self.router.escalation_tier}'")
+            tier = self.router.escalation_tier
+            response = self.llm.generate(messages=messages, level=tier, cache=True)
+            usage = token_usage(response, usage)
         return Command(update={"answer": response.content,
-                               "input_tokens_count": state["input_tokens_count"] + response.usage_metadata["input_tokens"],
-                               "output_tokens_count": state["output_tokens_count"] + response.usage_metadata["output_tokens"]},
+                               "model_tier": tier,
+                               **usage},
                        goto=END)
 
     def invoke(self, input: dict[str, Any]):
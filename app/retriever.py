@@ -1,44 +1,87 @@
+import json
 import logging
+import uuid
 from typing import List, Tuple
 
 from langchain_aws import BedrockEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import InMemoryVectorStore
 from langchain_community.document_loaders import DirectoryLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pathlib import Path
 from langchain_core.documents import Document
+from langchain_core.load import dumpd, load
+from vector_index import DenseIndex, ScalarQuantizedIndex, mmr
 
 logger = logging.getLogger(__name__)
 
 
+def approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+
 class Retriever:
-    def __init__(self, embedder: BedrockEmbeddings | str,
+    CHILDREN_PER_PARENT = 4  # child chunks fetched for each requested parent section, to make up for deduplication
+
+    def __init__(self, embedder: Embeddings | str,
                  client=None,
                  vector_store: InMemoryVectorStore | str | None = None,
                  kb_folder: str | None = None,
-                 glob: str = '**/*.txt',
+                 glob: str | List[str] = '**/*.txt',
                  chunk_size: int = 500,
-                 chunk_overlap: int = 100):
-        if type(embedder) is BedrockEmbeddings:
+                 chunk_overlap: int = 100,
+                 parent_chunk_size: int | None = None,
+                 parent_token_budget: int = 3000,
+                 quantization: dict | None = None):
+        # contiguous index of the stored vectors used for search, int8 quantised if enabled
+        # (quantisation is only available for vector stores loaded from file)
+        self.quantization = quantization or {}
+        self.index = None
+        if isinstance(embedder, Embeddings):
             self.embeddings = embedder
         else:
             self.embeddings = BedrockEmbeddings(model_id=embedder, client=client)
-        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        # small-to-big: if parent_chunk_size is set, small non-overlapping child chunks are embedded
+        # and mapped to the larger parent sections they come from, which are returned by retrieval
+        self.parents = {}
+        self.parent_token_budget = parent_token_budget
+        if parent_chunk_size is not None:
+            self.parent_splitter = RecursiveCharacterTextSplitter(chunk_size=parent_chunk_size, chunk_overlap=0)
+            self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+        else:
+            self.parent_splitter = None
+            self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
         if type(vector_store) is InMemoryVectorStore:
             self.vector_store = vector_store
+            self.index = DenseIndex.from_store(self.vector_store.store)
         elif type(vector_store) is str:
-            self.vector_store = InMemoryVectorStore.load(vector_store, self.embeddings)
+            self.load_vector_store(vector_store)
         else:
             self.vector_store = InMemoryVectorStore(self.embeddings)
             if kb_folder is not None:
                 self.__load_docs__(folder=kb_folder, glob=glob)
+            self.index = DenseIndex.from_store(self.vector_store.store)
 
-    def __load_docs__(self, folder: str, glob: str):
-        loader = DirectoryLoader(folder, glob=glob, show_progress=True)
-        docs = loader.load()
-        all_splits = self.splitter.split_documents(docs)
+    def __load_docs__(self, folder: str, glob: str | List[str]):
+        docs = []
+        for pattern in ([glob] if type(glob) is str else glob):
+            loader = DirectoryLoader(folder, glob=pattern, show_progress=True)
+            docs += loader.load()
+        all_splits = self.__split__(docs)
         _ = self.vector_store.add_documents(documents=all_splits)
 
+    def __split__(self, docs: List[Document]) -> List[Document]:
+        if self.parent_splitter is None:
+            return self.splitter.split_documents(docs)
+        children = []
+        for parent in self.parent_splitter.split_documents(docs):
+            parent_id = str(uuid.uuid4())
+            self.parents[parent_id] = {"id": parent_id, "text": parent.page_content, "metadata": parent.metadata}
+            for child in self.splitter.split_documents([parent]):
+                child.metadata["parent_id"] = parent_id
+                children.append(child)
+        return children
+
     def upload_file(self, filepath):
         logger.debug(f"Uploading {filepath}...")
         name = Path(filepath).name
@@ -46,28 +89,138 @@ class Retriever:
             content = f.read()
         logger.debug(content[:100])
         doc = Document(id=name, page_content=content, metadata={"extra": True, "source": name})
-        all_splits = self.splitter.split_documents([doc])
+        all_splits = self.__split__([doc])
         logger.debug(f"{len(all_splits)} splits created for {name}")
-        _ = self.vector_store.add_documents(documents=all_splits)
+        vectors = self.embeddings.embed_documents([split.page_content for split in all_splits])
+        ids = [str(uuid.uuid4()) for _ in all_splits]
+        quantized = type(self.index) is ScalarQuantizedIndex
+        for doc_id, split, vector in zip(ids, all_splits, vectors):
+            self.vector_store.store[doc_id] = {"id": doc_id, "text": split.page_content, "metadata": split.metadata}
+            if not quantized:
+                self.vector_store.store[doc_id]["vector"] = vector
+        self.index.add(ids, vectors)
         logger.debug(f"Vector store updated with {name}.")
         return None
 
     def save_vector_store(self, file_path: str):
-        self.vector_store.dump(file_path)
+        if type(self.index) is ScalarQuantizedIndex:
+            # quantised stores keep no vectors in memory: take them back from the full-precision index
+            store = {doc_id: {**record, "vector": self.index.vectors([self.index.rows[doc_id]])[0].tolist()}
+                     for doc_id, record in self.vector_store.store.items()}
+        else:
+            store = self.vector_store.store
+        # parent-child stores wrap the (child) vector store together with the parent sections
+        data = {"store": dumpd(store), "parents": self.parents} if self.parents else dumpd(store)
+        Path(file_path).parent.mkdir(exist_ok=True, parents=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
 
     def load_vector_store(self, file_path: str):
-        self.vector_store = InMemoryVectorStore.load(file_path, self.embeddings)
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        is_parent_child = "store" in data and "parents" in data
+        self.vector_store = InMemoryVectorStore(self.embeddings)
+        self.vector_store.store = load(data["store"] if is_parent_child else data, allowed_objects=[Document])
+        self.parents = data["parents"] if is_parent_child else {}
+        if self.quantization.get("enabled", False):
+            self.__quantize__(file_path)
+        else:
+            self.index = DenseIndex.from_store(self.vector_store.store)
+
+    def __quantize__(self, file_path: str):
+        self.index = ScalarQuantizedIndex.from_store(f"{file_path}.q8", self.vector_store.store, source_path=file_path)
+        # from now on the vectors live in the index only
+        for record in self.vector_store.store.values():
+            record.pop("vector", None)
+        logger.info(f"Vector store quantised: {len(self.index)} vectors, {self.index.memory_usage()/1e6:.2f} MB in memory")
+
+    def __document__(self, doc_id: str) -> Document:
+        record = self.vector_store.store[doc_id]
+        return Document(id=record["id"], page_content=record["text"], metadata=record["metadata"])
+
+    def __documents__(self, rows) -> List[Document]:
+        return [self.__document__(self.index.ids[row]) for row in rows]
+
+    def __expand__(self, rows, scores, n: int) -> Tuple[List[Document], List[float]]:
+        """
+        Replace the retrieved child chunks with their parent sections, deduplicated, keeping the best child score.
+        Parents are expanded lazily within the token budget: a parent that does not fit in what is left
+        of the budget is not expanded, and its child chunk is returned instead.
+        """
+        if not self.parents:
+            return self.__documents__(rows[:n]), scores[:n]
+        docs, doc_scores, seen = [], [], set()
+        budget = self.parent_token_budget
+        for row, score in zip(rows, scores):
+            child = self.__document__(self.index.ids[row])
+            parent_id = child.metadata.get("parent_id")
+            if parent_id is not None and parent_id in seen:
+                continue
+            seen.add(parent_id)
+            parent = self.parents.get(parent_id)
+            if parent is not None and approx_tokens(parent["text"]) <= budget:
+                doc = Document(id=parent_id, page_content=parent["text"], metadata=parent["metadata"])
+            else:
+                doc = child
+            budget -= approx_tokens(doc.page_content)
+            docs.append(doc)
+            doc_scores.append(score)
+            if len(docs) == n:
+                break
+        return docs, doc_scores
 
     def embed(self, query: str):
         return self.embeddings.embed_query(query)
 
-    def retrieve(self, query:str, n=5) -> List[Document]:
-        return self.vector_store.similarity_search(query, k=n)
+    def retrieve(self, query:str, n=5, query_vector: List[float] | None = None) -> List[Document]:
+        return self.retrieve_with_scores(query, n=n, score_threshold=-1.0, query_vector=query_vector)[0]
 
     #Maximal marginal relevance optimizes for similarity to query and diversity among selected documents.
-    def retrieve_diverse(self, query: str, n=10) -> List[Document]:
-        return self.vector_store.max_marginal_relevance_search(query, k=n, fetch_k=n*10)
+    def retrieve_diverse(self, query: str, n=10, fetch_k: int | None = None, lambda_mult: float = 0.5,
+                         query_vector: List[float] | None = None) -> List[Document]:
+        return self.retrieve_diverse_with_scores(query, n=n, score_threshold=-1.0, fetch_k=fetch_k,
+                                                 lambda_mult=lambda_mult, query_vector=query_vector)[0]
+
+    def retrieve_diverse_with_scores(self, query: str, n=10, score_threshold=0.5, fetch_k: int | None = None,
+                                     lambda_mult: float = 0.5, query_vector: List[float] | None = None) -> Tuple[List[Document], List[float]]:
+        """Like retrieve_with_scores, but the n documents are picked with MMR among the fetch_k most similar ones.
+        Scores are the similarities with the query, candidates below score_threshold are discarded before MMR."""
+        query_vector = query_vector if query_vector is not None else self.embed(query)
+        k = n * self.CHILDREN_PER_PARENT if self.parents else n
+        rows, scores = self.index.search(query_vector, k=fetch_k or k*10, rescore_factor=self.quantization.get("rescore-factor", 4))
+        candidates = [i for i, score in enumerate(scores) if score>=score_threshold]
+        selected = [candidates[i] for i in mmr(query_vector, self.index.vectors([rows[i] for i in candidates]), k=k, lambda_mult=lambda_mult)]
+        return self.__expand__([rows[i] for i in selected], [scores[i] for i in selected], n)
+
+    def retrieve_with_scores(self, query:str, n=5, score_threshold=0.5, query_vector: List[float] | None = None) -> Tuple[List[Document], List[float]]:
+        query_vector = query_vector if query_vector is not None else self.embed(query)
+        k = n * self.CHILDREN_PER_PARENT if self.parents else n
+        rows, scores = self.index.search(query_vector, k=k, rescore_factor=self.quantization.get("rescore-factor", 4))
+        docs_retrieved = [(row, score) for row, score in zip(rows, scores) if score>=score_threshold]
+        return self.__expand__([doc[0] for doc in docs_retrieved], [doc[1] for doc in docs_retrieved], n)
+
 
-    def retrieve_with_scores(self, query:str, n=5, score_threshold=0.5) -> List[Tuple[Document, float]]:
-        docs_retrieved = [doc for doc in self.vector_store.similarity_search_with_score(query, k=n) if doc[1]>=score_threshold]
-        return [doc[0] for doc in docs_retrieved], [doc[1] for doc in docs_retrieved]
\ No newline at end of file
+if __name__ == "__main__":
+    # rebuild the vector store from the knowledge base folder, e.g. after changing the chunking settings
+    import argparse
+    import os
+    import boto3
+    import yaml
+    parser = argparse.ArgumentParser(description="Rebuild the vector store from the knowledge base folder.")
+    parser.add_argument('--settings', action="store", dest='settings_file', default='settings.yaml')
+    parser.add_argument('--output', action="store", dest='output', default=None, help="defaults to vector-db-path")
+    rebuild_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with open(rebuild_args.settings_file) as stream:
+        config = yaml.safe_load(stream)
+    os.chdir(os.path.abspath(os.path.dirname(rebuild_args.settings_file)))
+    retriever = Retriever(config.get("bedrock").get("embedder-id"),
+                          client=boto3.Session().client("bedrock-runtime", region_name=config.get("bedrock").get("region")),
+                          kb_folder=config.get("kb-folder"),
+                          glob=config.get("globs", '**/*.txt'),
+                          chunk_size=config.get("chunk-size", 500),
+                          chunk_overlap=config.get("chunk-overlap", 100),
+                          parent_chunk_size=config.get("parent-chunk-size", None))
+    output = rebuild_args.output or config.get("vector-db-path")
+    retriever.save_vector_store(output)
+    logger.info(f"Vector store with {len(retriever.vector_store.store)} chunks and {len(retriever.parents)} parent sections saved in {output}")
@@ -0,0 +1,107 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# language model tiers, from the cheapest/fastest to the most capable
+TIERS = ["ultralow", "low", "standard", "pro"]
+
+DEFAULT_THRESHOLDS = {
+    "simple-max-question-words": 25,  # short questions are likely simple lookups...
+    "simple-min-top-score": 0.75,  # ...if the best source is a confident match...
+    "simple-max-score-spread": 0.1,  # ...the retrieved sources agree with each other...
+    "simple-max-sources": 4,  # ...there are few of them...
+    "simple-max-history-depth": 0,  # ...and there is no previous conversation
+    "complex-min-question-words": 60,  # long, articulated questions always get the best model
+    "complex-max-top-score": 0.65,  # as well as weakly supported ones
+    "complex-min-history-depth": 3,  # and deep consultations
+}
+
+CITATION_PATTERN = re.compile(r"\[\s*\d+")
+
+
+class ModelRouter:
+    """
+    Choose the language model tier used by the generator for each request.
+    Policies:
+        - fixed: always use the default tier (previous behaviour);
+        - heuristic: pick the tier from retrieval and conversation signals
+          (cheap tier for simple lookups, pro tier for complex or weakly supported questions).
+    In shadow mode the policy decision is only logged, while the default tier is used.
+    """
+    POLICIES = ["fixed", "heuristic"]
+
+    def __init__(self, policy: str = "fixed",
+                 default_tier: str = "pro",
+                 escalation_tier: str = "pro",
+                 shadow: bool = False,
+                 escalation: bool = True,
+                 thresholds: dict | None = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown routing policy '{policy}'. Available policies: {self.POLICIES}")
+        for tier in (default_tier, escalation_tier):
+            if tier not in TIERS:
+                raise ValueError(f"Unknown model tier '{tier}'. Available tiers: {TIERS}")
+        self.policy = policy
+        self.default_tier = default_tier
+        self.escalation_tier = escalation_tier
+        self.shadow = shadow
+        self.escalation = escalation
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+
+    @classmethod
+    def from_config(cls, config: dict | None):
+        config = config or {}
+        return cls(policy=config.get("policy", "fixed"),
+                   default_tier=config.get("default-tier", "pro"),
+                   escalation_tier=config.get("escalation-tier", "pro"),
+                   shadow=config.get("shadow", False),
+                   escalation=config.get("escalation", True),
+                   thresholds=config.get("thresholds"))
+
+    def signals(self, state: dict) -> dict:
+        scores = state.get("context", {}).get("scores", [])
+        additional_context = state.get("additional_context", None)
+        has_additional_context = type(additional_context) is str and additional_context != ""
+        return {
+            # the augmented question is an LLM-generated answer, its length says nothing about the user question
+            "question_words": None if state.get("query_aug") else len(state["question"].split()),
+            "top_score": max(scores) if scores else 0.0,
+            "score_spread": max(scores) - min(scores) if scores else 0.0,
+            "sources": len(scores) + (1 if has_additional_context else 0),
+            "history_depth": state.get("history_depth", 0),
+        }
+
+    def __heuristic__(self, signals: dict) -> str:
+        t = self.thresholds
+        words = signals["question_words"]
+        if ((words is not None and words >= t["complex-min-question-words"])
+                or signals["top_score"] <= t["complex-max-top-score"]
+                or signals["history_depth"] >= t["complex-min-history-depth"]):
+            return "pro"
+        if (words is not None and words <= t["simple-max-question-words"]
+                and signals["top_score"] >= t["simple-min-top-score"]
+                and signals["score_spread"] <= t["simple-max-score-spread"]
+                and signals["sources"] <= t["simple-max-sources"]
+                and signals["history_depth"] <= t["simple-max-history-depth"]):
+            return "low"
+        return "standard"
+
+    def route(self, state: dict) -> str:
+        if self.policy == "fixed":
+            return self.default_tier
+        signals = self.signals(state)
+        tier = self.__heuristic__(signals)
+        if self.shadow:
+            logger.info(f"[shadow] routing policy '{self.policy}' would use tier '{tier}' instead of '{self.default_tier}' ({signals})")
+            return self.default_tier
+        logger.info(f"Routing policy '{self.policy}' selected tier '{tier}' ({signals})")
+        return tier
+
+    def needs_escalation(self, tier: str, answer: str, sources: int) -> bool:
+        """An answer from a cheaper tier is escalated if it is empty or cites no source although sources were given."""
+        if not self.escalation or TIERS.index(tier) >= TIERS.index(self.escalation_tier):
+            return False
+        if type(answer) is not str or answer.strip() == "":
+            return True
+        return sources > 0 and CITATION_PATTERN.search(answer) is None
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+import re
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(question: str, empty_history: bool, query_aug: bool, additional_context: str | None, mode: str | None = None) -> tuple:
+    """
+    Requests with the same key get the same answer: normalised question, history flag, query augmentation,
+    additional context hash and service mode (a degraded mode changes how the answer is produced).
+    """
+    return (re.sub(r"\s+", " ", question).strip().casefold(),
+            empty_history,
+            bool(query_aug),
+            hashlib.sha256((additional_context or "").encode("utf-8")).hexdigest(),
+            mode or "normal")
+
+
+def share(total: int, participants: int, leader: bool) -> int:
+    """Even share of the tokens of a coalesced call, the leader also takes the remainder."""
+    quota = total // participants
+    return quota + (total - quota * participants if leader else 0)
+
+
+class SingleFlight:
+    """
+    Coalescing of identical concurrent calls: the first caller of a key (the leader) runs the function,
+    the callers arriving with the same key while it is running wait for its result instead of running it again.
+    Results are not cached: once the call completes, the next caller of the key starts a new one.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.coalesced = 0
+        self.__calls__ = {}
+        self.__lock__ = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict | None):
+        config = config or {}
+        return cls(enabled=config.get("enabled", True))
+
+    def do(self, key, function) -> tuple:
+        """Returns the result, the number of callers that shared it and whether this caller ran the function."""
+        if not self.enabled:
+            return function(), 1, True
+        with self.__lock__:
+            call = self.__calls__.get(key)
+            leader = call is None
+            if leader:
+                call = {"future": Future(), "participants": 1}
+                self.__calls__[key] = call
+            else:
+                call["participants"] += 1
+                self.coalesced += 1
+        if not leader:
+            logger.debug(f"Joining the in-flight call for {key[0][:30]}...")
+            return call["future"].result(), call["participants"], False
+        try:
+            result = function()
+        except BaseException as e:
+            with self.__lock__:
+                self.__calls__.pop(key, None)
+            call["future"].set_exception(e)
+            raise
+        # no caller can join once the call is removed, so the number of participants is final
+        with self.__lock__:
+            self.__calls__.pop(key, None)
+        call["future"].set_result(result)
+        if call["participants"] > 1:
+            logger.info(f"{call['participants']} identical requests served by a single pipeline run")
+        return result, call["participants"], True
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(vectors: np.ndarray, scale: np.ndarray, offset: np.ndarray) -> np.ndarray:
+    codes = np.rint((vectors - offset) / scale) - 128
+    return np.clip(codes, -128, 127).astype(np.int8)
+
+
+def mmr(query, candidates: np.ndarray, k: int, lambda_mult: float = 0.5) -> list[int]:
+    """
+    Greedy maximal marginal relevance over normalised candidate vectors.
+    Instead of recomputing the candidate-candidate similarity matrix, the maximum similarity of each
+    candidate to the selected set is updated incrementally with one matrix-vector product per pick.
+    Returns the positions of the selected candidates, in selection order.
+    """
+    k = min(k, len(candidates))
+    if k <= 0:
+        return []
+    relevance = candidates @ normalize(query)[0]
+    selected = [int(np.argmax(relevance))]
+    max_similarity = candidates @ candidates[selected[0]]
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        np.maximum(max_similarity, candidates @ candidates[pick], out=max_similarity)
+    return selected
+
+
+class DenseIndex:
+    """
+    Contiguous float32 matrix of the (unit-normalised) embeddings of a vector store,
+    so that all the similarities with a query are computed with a single matrix-vector product.
+    """
+
+    def __init__(self, ids: list[str], vectors):
+        self.ids = list(ids)
+        self.rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self.matrix = normalize(vectors) if len(self.ids) > 0 else np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_store(cls, store: dict):
+        ids = list(store.keys())
+        return cls(ids, [store[doc_id]["vector"] for doc_id in ids])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids: list[str], vectors):
+        vectors = normalize(vectors)
+        self.matrix = vectors if len(self.ids) == 0 else np.concatenate([self.matrix, vectors])
+        for doc_id in ids:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+
+    def vectors(self, rows) -> np.ndarray:
+        return self.matrix[np.asarray(rows, dtype=np.int64)]
+
+    def search(self, query, k: int = 5, **kwargs) -> tuple[list[int], list[float]]:
+        """Rows and cosine scores of the k nearest vectors, sorted by decreasing score."""
+        if len(self.ids) == 0:
+            return [], []
+        scores = self.matrix @ normalize(query)[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top.tolist(), scores[top].tolist()
+
+    def memory_usage(self) -> int:
+        return self.matrix.nbytes
+
+
+class ScalarQuantizedIndex:
+    """
+    int8 scalar quantisation of the (unit-normalised) embeddings of a vector store.
+    Only the int8 codes are kept in memory and searched directly; the full-precision vectors are
+    kept on disk (memory-mapped) and used to re-score the shortlist only, so that the returned
+    scores are the exact cosine similarities.
+    Files are stored in a sidecar folder next to the vector store (e.g. reuma.db.q8/).
+    """
+    BLOCK_SIZE = 8192  # rows scored at a time, bounds the temporary float32 memory used by a search
+
+    def __init__(self, folder: str, ids: list[str], codes: np.ndarray, scale: np.ndarray, offset: np.ndarray):
+        self.folder = folder
+        self.ids = ids
+        self.rows = {doc_id: i for i, doc_id in enumerate(ids)}
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        self.disk_count = len(ids)
+        self.full_vectors = np.memmap(os.path.join(folder, "vectors.f32"), dtype=np.float32, mode="r",
+                                      shape=(self.disk_count, codes.shape[1])) if self.disk_count > 0 else None
+        # vectors added at runtime (e.g. uploaded files) are not persisted and stay in memory
+        self.extra_vectors = np.zeros((0, codes.shape[1]), dtype=np.float32)
+
+    @classmethod
+    def build(cls, folder: str, ids: list[str], vectors, source_mtime: float | None = None):
+        vectors = normalize(vectors)
+        offset = vectors.min(axis=0)
+        scale = (vectors.max(axis=0) - offset) / 255
+        scale[scale == 0] = 1.0
+        scale, offset = scale.astype(np.float32), offset.astype(np.float32)
+        codes = quantize(vectors, scale, offset)
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(os.path.join(folder, "meta.json")):
+            os.remove(os.path.join(folder, "meta.json"))
+        vectors.tofile(os.path.join(folder, "vectors.f32"))
+        np.save(os.path.join(folder, "codes.npy"), codes)
+        np.savez(os.path.join(folder, "params.npz"), scale=scale, offset=offset)
+        # meta.json is written last: its presence marks a complete index
+        with open(os.path.join(folder, "meta.json"), "w") as file:
+            json.dump({"ids": list(ids), "dim": int(vectors.shape[1]), "source_mtime": source_mtime}, file)
+        logger.info(f"Quantised index with {len(ids)} vectors saved in {folder}")
+        return cls(folder, list(ids), codes, scale, offset)
+
+    @classmethod
+    def load(cls, folder: str, source_mtime: float | None = None):
+        """Load the index from its folder, returns None if missing or out of date with respect to its source."""
+        try:
+            with open(os.path.join(folder, "meta.json")) as file:
+                meta = json.load(file)
+            if source_mtime is not None and meta.get("source_mtime") != source_mtime:
+                logger.info(f"Quantised index in {folder} is out of date")
+                return None
+            params = np.load(os.path.join(folder, "params.npz"))
+            codes = np.load(os.path.join(folder, "codes.npy"))
+            return cls(folder, meta["ids"], codes, params["scale"], params["offset"])
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def from_store(cls, folder: str, store: dict, source_path: str | None = None):
+        """Load the index of an InMemoryVectorStore content, building it if needed."""
+        source_mtime = os.path.getmtime(source_path) if source_path is not None else None
+        index = cls.load(folder, source_mtime) if source_mtime is not None else None
+        if index is None or set(index.ids) != set(store.keys()):
+            ids = list(store.keys())
+            index = cls.build(folder, ids, [store[doc_id]["vector"] for doc_id in ids], source_mtime)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids: list[str], vectors):
+        vectors = normalize(vectors)
+        self.codes = np.concatenate([self.codes, quantize(vectors, self.scale, self.offset)])
+        self.extra_vectors = np.concatenate([self.extra_vectors, vectors])
+        for doc_id in ids:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+
+    def vectors(self, rows) -> np.ndarray:
+        """Full-precision (normalised) vectors of the given rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.codes.shape[1]), dtype=np.float32)
+        on_disk = rows < self.disk_count
+        if on_disk.any():
+            out[on_disk] = self.full_vectors[rows[on_disk]]
+        if (~on_disk).any():
+            out[~on_disk] = self.extra_vectors[rows[~on_disk] - self.disk_count]
+        return out
+
+    def approximate_scores(self, query) -> np.ndarray:
+        # q·v ≈ q·((c+128)*scale + offset) = (q*scale)·c + q·(128*scale + offset)
+        query = normalize(query)[0]
+        weights = query * self.scale
+        bias = float(query @ (128 * self.scale + self.offset))
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.BLOCK_SIZE):
+            block = self.codes[start:start + self.BLOCK_SIZE]
+            scores[start:start + self.BLOCK_SIZE] = block.astype(np.float32) @ weights + bias
+        return scores
+
+    def search(self, query, k: int = 5, rescore_factor: int = 4) -> tuple[list[int], list[float]]:
+        """Rows and exact cosine scores of the k nearest vectors, sorted by decreasing score."""
+        if len(self.ids) == 0:
+            return [], []
+        approximate = self.approximate_scores(query)
+        shortlist_size = min(len(approximate), max(k * rescore_factor, k))
+        shortlist = np.argpartition(-approximate, shortlist_size - 1)[:shortlist_size]
+        exact = self.vectors(shortlist) @ normalize(query)[0]
+        order = np.argsort(-exact)[:k]
+        return shortlist[order].tolist(), exact[order].tolist()
+
+    def memory_usage(self) -> int:
+        """Bytes held in memory by the index (codes and runtime additions, the mmap is excluded)."""
+        return self.codes.nbytes + self.extra_vectors.nbytes + self.scale.nbytes + self.offset.nbytes
+
+
+def benchmark(vector_store_path: str, k: int = 10, queries: int = 200, rescore_factors=(1, 2, 4, 8), seed: int = 0):
+    """Compare recall@k, latency and memory of the quantised index with the exact float search."""
+    with open(vector_store_path) as file:
+        store = json.load(file)
+    # parent-child stores wrap the (child) vector store together with the parent sections
+    if "store" in store and "parents" in store:
+        store = store["store"]
+    ids = list(store.keys())
+    vectors = normalize([store[doc_id]["vector"] for doc_id in ids])
+    python_lists_bytes = sum(sys.getsizeof(store[doc_id]["vector"]) + sum(sys.getsizeof(v) for v in store[doc_id]["vector"]) for doc_id in ids)
+    folder = tempfile.TemporaryDirectory()
+    index = ScalarQuantizedIndex.build(folder.name, ids, vectors)
+    # synthetic queries: mixtures of two stored vectors plus noise
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, len(ids), size=(queries, 2))
+    query_vectors = normalize(vectors[pairs[:, 0]] + vectors[pairs[:, 1]] + rng.normal(0, 0.01, size=(queries, vectors.shape[1])))
+    start = time.perf_counter()
+    exact_top = [set(np.argsort(-(vectors @ q))[:k].tolist()) for q in query_vectors]
+    exact_latency = (time.perf_counter() - start) / queries
+    print(f"vectors: {len(ids)} x {vectors.shape[1]}")
+    print(f"memory - python lists: {python_lists_bytes / 1e6:.2f} MB | float32 matrix: {vectors.nbytes / 1e6:.2f} MB | int8 index: {index.memory_usage() / 1e6:.2f} MB")
+    print(f"exact float32 search: {exact_latency * 1e3:.3f} ms/query")
+    for factor in rescore_factors:
+        start = time.perf_counter()
+        results = [set(index.search(q, k=k, rescore_factor=factor)[0]) for q in query_vectors]
+        latency = (time.perf_counter() - start) / queries
+        recall = np.mean([len(r & e) / k for r, e in zip(results, exact_top)])
+        print(f"int8 + re-scoring x{factor}: recall@{k} {recall:.4f}, {latency * 1e3:.3f} ms/query")
+    folder.cleanup()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the quantised index against the exact search.")
+    parser.add_argument("vector_store", help="path of the vector store file (e.g. ./data/reuma.db)")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    bench_args = parser.parse_args()
+    benchmark(bench_args.vector_store, k=bench_args.k, queries=bench_args.queries)